@@ -0,0 +1,579 @@
+"""迁移工具的离线基准测试
+
+用进程内的假对象存储替代 oss2.Bucket / CosS3Client / Minio，可配置延迟、带宽和错误注入，
+在不访问真实云服务的情况下测量列举、download_file、FileStatus 和上传等路径的性能。
+
+用法示例：
+    python benchmark.py --workload tiny --count 100000 --scenarios list download status
+    python benchmark.py --workload mixed --latency-ms 20 --error-rate 0.01 --output run1.json
+    python benchmark.py --workload huge --compare run1.json
+
+每次运行都在临时目录中进行，需要安装 requirements.txt 中的依赖。
+"""
+import argparse
+import bisect
+import hashlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+# 基准测试使用的占位配置，客户端会被替换成假对象，不会连接任何服务
+BENCH_CONFIG = """
+aliyun: {access_key: bench, access_secret: bench, endpoint: localhost, bucket: bench}
+tencent: {secret_id: bench, secret_key: bench, region: local, bucket: bench}
+minio: {endpoint: 'localhost:9000', access_key: bench, secret_key: bench, bucket: bench, secure: false}
+"""
+
+WORKLOADS = {
+    # 100万个256B~4KB的小对象
+    'tiny': {'count': 1000000, 'sizes': lambda rng: rng.randint(256, 4096)},
+    # 对数正态分布，大部分几十KB，少量几十MB
+    'mixed': {'count': 10000, 'sizes': lambda rng: min(int(rng.lognormvariate(10.5, 2.0)), 256 * 1024 * 1024)},
+    # 少量超大对象
+    'huge': {'count': 3, 'sizes': lambda rng: 512 * 1024 * 1024},
+}
+
+SCENARIOS = ['list', 'download', 'upload', 'direct', 'status']
+
+class FakeServiceError(Exception):
+    """模拟SDK的服务端错误，带status和code属性，迁移工具据此判断是否限流/可重试"""
+    def __init__(self, status, code):
+        super().__init__(f"{status} {code}")
+        self.status = status
+        self.code = code
+
+class LinkModel:
+    """模拟一条网络链路：每个请求的固定延迟、共享带宽和随机错误"""
+    def __init__(self, latency=0.0, bandwidth=0, error_rate=0.0, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+        self.requests = 0
+        self.injected_errors = 0
+
+    def request(self):
+        """一次请求的往返延迟，并按概率注入错误"""
+        with self.lock:
+            self.requests += 1
+            roll = self.rng.random()
+        if self.latency:
+            time.sleep(self.latency)
+        if roll < self.throttle_rate:
+            with self.lock:
+                self.injected_errors += 1
+            raise FakeServiceError(503, 'SlowDown')
+        if roll < self.throttle_rate + self.error_rate:
+            with self.lock:
+                self.injected_errors += 1
+            raise FakeServiceError(500, 'InternalError')
+
+    def transfer(self, nbytes):
+        """按共享带宽排队传输nbytes字节"""
+        if not self.bandwidth:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + nbytes / self.bandwidth
+            wait = self.next_free - now
+        time.sleep(wait)
+
+def payload_block(key):
+    """对象内容由key决定，按需生成，不在内存中保存对象数据"""
+    return hashlib.sha256(key.encode('utf-8')).digest() * 2048
+
+def payload_md5(key, size):
+    md5 = hashlib.md5()
+    block = payload_block(key)
+    while size > 0:
+        chunk = block[:size]
+        md5.update(chunk)
+        size -= len(chunk)
+    return md5.hexdigest()
+
+class PayloadStream:
+    """按需生成对象内容的只读流"""
+    def __init__(self, key, start, end, link):
+        self.block = payload_block(key)
+        self.pos = start
+        self.end = end
+        self.link = link
+        self.content_length = end - start
+
+    def read(self, size=-1):
+        remaining = self.end - self.pos
+        if remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        offset = self.pos % len(self.block)
+        data = (self.block[offset:] + self.block * (size // len(self.block) + 1))[:size]
+        self.pos += size
+        self.link.transfer(size)
+        return data
+
+    def close(self):
+        pass
+
+class SourceStore:
+    """按key排序保存的假源端bucket"""
+    def __init__(self, objects, link):
+        self.keys = sorted(objects)
+        self.sizes = objects
+        self.link = link
+        self.mtime = time.time() - 86400
+        # 预先计算内容MD5作为ETag，避免计入列举耗时
+        print(f"生成 {len(objects)} 个对象的ETag...")
+        self.etags = {key: payload_md5(key, size) for key, size in objects.items()}
+
+    def etag(self, key):
+        return self.etags[key].upper()
+
+    def list_page(self, prefix, marker, delimiter, max_keys):
+        self.link.request()
+        index = bisect.bisect_right(self.keys, marker) if marker else bisect.bisect_left(self.keys, prefix)
+        objects, prefixes, last = [], [], None
+        while index < len(self.keys) and len(objects) + len(prefixes) < max_keys:
+            key = self.keys[index]
+            if not key.startswith(prefix):
+                break
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest.split(delimiter, 1)[0] + delimiter
+                prefixes.append(common)
+                # 跳过该公共前缀下的所有key
+                index = bisect.bisect_left(self.keys, common + '\U0010ffff')
+                last = common
+                continue
+            objects.append(key)
+            last = key
+            index += 1
+        truncated = index < len(self.keys) and self.keys[index].startswith(prefix)
+        return objects, prefixes, truncated, last
+
+    def open(self, key, start=0, end=None):
+        self.link.request()
+        size = self.sizes[key]
+        end = size if end is None else min(end + 1, size)
+        return PayloadStream(key, start, end, self.link)
+
+class FakeObjectInfo:
+    def __init__(self, key, size, etag, last_modified):
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+
+class FakeListResult:
+    def __init__(self, object_list, prefix_list, is_truncated, next_marker):
+        self.object_list = object_list
+        self.prefix_list = prefix_list
+        self.is_truncated = is_truncated
+        self.next_marker = next_marker
+
+class FakeHeadResult:
+    def __init__(self, content_length, etag):
+        self.content_length = content_length
+        self.etag = etag
+        self.headers = {}
+
+class FakeOssBucket:
+    """模拟迁移工具用到的 oss2.Bucket 接口"""
+    def __init__(self, store):
+        self.store = store
+
+    def list_objects(self, prefix='', delimiter='', marker='', max_keys=100):
+        keys, prefixes, truncated, last = self.store.list_page(prefix, marker, delimiter, max_keys)
+        object_list = [
+            FakeObjectInfo(key, self.store.sizes[key], self.store.etag(key), int(self.store.mtime))
+            for key in keys
+        ]
+        return FakeListResult(object_list, prefixes, truncated, last if truncated else '')
+
+    def head_object(self, key):
+        self.store.link.request()
+        return FakeHeadResult(self.store.sizes[key], self.store.etag(key))
+
+    def get_object(self, key, byte_range=None):
+        start, end = byte_range if byte_range else (0, None)
+        stream = self.store.open(key, start, end)
+        stream.etag = self.store.etag(key)
+        return stream
+
+class FakeCosBody:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def get_raw_stream(self):
+        return self.stream
+
+class FakeCosClient:
+    """模拟迁移工具用到的 CosS3Client 接口"""
+    def __init__(self, store):
+        self.store = store
+
+    def list_objects(self, Bucket, Prefix='', Delimiter='', Marker='', MaxKeys=1000):
+        keys, prefixes, truncated, last = self.store.list_page(Prefix, Marker, Delimiter, MaxKeys)
+        modified = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(self.store.mtime))
+        response = {'IsTruncated': 'true' if truncated else 'false', 'NextMarker': last or ''}
+        if keys:
+            response['Contents'] = [
+                {'Key': key, 'Size': str(self.store.sizes[key]),
+                 'ETag': f'"{self.store.etag(key)}"', 'LastModified': modified}
+                for key in keys
+            ]
+        if prefixes:
+            response['CommonPrefixes'] = [{'Prefix': prefix} for prefix in prefixes]
+        return response
+
+    def head_object(self, Bucket, Key):
+        self.store.link.request()
+        return {'Content-Length': str(self.store.sizes[Key]), 'ETag': f'"{self.store.etag(Key)}"'}
+
+    def get_object(self, Bucket, Key, Range=None):
+        start, end = 0, None
+        if Range:
+            start, end = (int(value) for value in Range[len('bytes='):].split('-'))
+        stream = self.store.open(Key, start, end)
+        return {
+            'Body': FakeCosBody(stream),
+            'Content-Length': str(stream.content_length),
+            'ETag': f'"{self.store.etag(Key)}"'
+        }
+
+class FakeMinioObject:
+    def __init__(self, object_name, size, etag, last_modified, metadata=None):
+        self.object_name = object_name
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.metadata = metadata or {}
+        self.is_dir = False
+
+class FakeWriteResult:
+    def __init__(self, etag):
+        self.etag = etag
+
+class FakeMinio:
+    """模拟迁移工具用到的 Minio 接口，只保存对象的大小、ETag和元数据"""
+    def __init__(self, link):
+        self.link = link
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, bucket_name, object_name, data, length, part_size=0,
+                   metadata=None, num_parallel_uploads=3, **kwargs):
+        self.link.request()
+        part_size = part_size or 5 * 1024 * 1024
+        # 与MinIO一致：只有单次PutObject上传的tar才会解包，分片上传按普通对象保存
+        if (metadata or {}).get('X-Amz-Meta-Snowball-Auto-Extract') == 'true' and length <= part_size:
+            return self.extract_tar(data, length)
+        digests = []
+        whole = hashlib.md5()
+        remaining = length
+        while remaining > 0:
+            part = hashlib.md5()
+            left = min(part_size, remaining)
+            while left > 0:
+                chunk = data.read(min(left, 1024 * 1024))
+                if not chunk:
+                    raise IOError('数据流提前结束')
+                part.update(chunk)
+                whole.update(chunk)
+                left -= len(chunk)
+                self.link.transfer(len(chunk))
+            remaining -= min(part_size, remaining)
+            digests.append(part.digest())
+        if len(digests) <= 1:
+            etag = whole.hexdigest()
+        else:
+            etag = f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+        stored = FakeMinioObject(object_name, length, etag, _now_utc(), dict(metadata or {}))
+        with self.lock:
+            self.objects[object_name] = stored
+        return FakeWriteResult(etag)
+
+    def extract_tar(self, data, length):
+        """模拟MinIO的snowball自动解包：tar中的每个成员成为独立对象"""
+        content = data.read(length)
+        self.link.transfer(len(content))
+        with tarfile.open(fileobj=io.BytesIO(content)) as tar:
+            for member in tar.getmembers():
+                payload = tar.extractfile(member).read()
+                stored = FakeMinioObject(member.name, len(payload), hashlib.md5(payload).hexdigest(), _now_utc())
+                with self.lock:
+                    self.objects[member.name] = stored
+        return FakeWriteResult('')
+
+    def fput_object(self, bucket_name, object_name, file_path, metadata=None, part_size=0,
+                    num_parallel_uploads=3, **kwargs):
+        with open(file_path, 'rb') as f:
+            return self.put_object(
+                bucket_name, object_name, f, os.path.getsize(file_path), part_size, metadata
+            )
+
+    def copy_object(self, bucket_name, object_name, source, **kwargs):
+        self.link.request()
+        with self.lock:
+            original = self.objects.get(source.object_name)
+            if original is None:
+                raise FakeServiceError(404, 'NoSuchKey')
+            self.objects[object_name] = FakeMinioObject(
+                object_name, original.size, original.etag, _now_utc(), dict(original.metadata)
+            )
+        return FakeWriteResult(original.etag)
+
+    def stat_object(self, bucket_name, object_name):
+        self.link.request()
+        with self.lock:
+            stored = self.objects.get(object_name)
+        if stored is None:
+            raise FakeServiceError(404, 'NoSuchKey')
+        return stored
+
+    def remove_object(self, bucket_name, object_name):
+        self.link.request()
+        with self.lock:
+            self.objects.pop(object_name, None)
+
+    def list_objects(self, bucket_name, prefix='', recursive=False, start_after=None, **kwargs):
+        with self.lock:
+            names = sorted(
+                name for name in self.objects
+                if name.startswith(prefix or '') and (not start_after or name > start_after)
+            )
+        for index, name in enumerate(names):
+            if index % 1000 == 0:
+                self.link.request()
+            yield self.objects[name]
+
+def _now_utc():
+    from datetime import datetime, timezone
+    return datetime.now(timezone.utc)
+
+def make_objects(workload, count, seed):
+    """生成 {key: 大小}，key分散在多个顶层前缀下"""
+    rng = random.Random(seed)
+    spec = WORKLOADS[workload]
+    count = count or spec['count']
+    prefixes = max(1, min(100, count // 1000))
+    return {
+        f"{workload}/p{i % prefixes:03d}/obj-{i:08d}.bin": max(1, spec['sizes'](rng))
+        for i in range(count)
+    }
+
+def peak_rss_mb():
+    """进程启动以来的峰值常驻内存(MB)，Linux上ru_maxrss单位为KB，macOS上为字节
+
+    ru_maxrss不会随场景结束而回落，某个场景的值包含之前所有场景的峰值，
+    单独测量某个场景的内存时只运行该场景。
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+class Bench:
+    """在临时目录中加载迁移工具，并把客户端替换成假对象"""
+    def __init__(self, args):
+        self.args = args
+        self.origin = os.getcwd()
+        self.workdir = tempfile.mkdtemp(prefix='migrate-bench-')
+        with open(os.path.join(self.workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+            f.write(BENCH_CONFIG)
+        os.chdir(self.workdir)
+        import migrate_to_minio
+        self.m = migrate_to_minio
+        self.m.get_config().update({
+            'status': {'backend': args.status_backend},
+            'transfer': {'aliyun_workers': args.workers, 'tencent_workers': args.workers},
+            'upload': {'workers': args.workers},
+            'retry': {'base_delay': 0.01, 'max_delay': 0.5},
+            'metrics': {'stats_file': ''},
+            'batch': {'enabled': args.batch},
+            # 各场景使用同一组对象，开启去重时后面的场景只会做服务端复制，测不到真实传输
+            'dedup': {'enabled': args.dedup},
+        })
+        self.objects = make_objects(args.workload, args.count, args.seed)
+        source_link = LinkModel(args.latency_ms / 1000, args.bandwidth_mbps * 1024 * 1024 / 8,
+                                args.error_rate, args.throttle_rate, args.seed)
+        self.minio_link = LinkModel(args.minio_latency_ms / 1000, args.minio_bandwidth_mbps * 1024 * 1024 / 8,
+                                    0, 0, args.seed + 1)
+        self.source_link = source_link
+        self.store = SourceStore(self.objects, source_link)
+        self.is_ali = args.source == 'aliyun'
+        self.m.create_ali_client = lambda: FakeOssBucket(self.store)
+        self.m.create_tx_client = lambda: FakeCosClient(self.store)
+        self.minio = FakeMinio(self.minio_link)
+        self.m.create_minio_client = lambda: self.minio
+
+    def reset(self):
+        """每个场景使用新的统计和并发控制器"""
+        self.m.metrics = self.m.Metrics()
+        self.m._limiters.clear()
+        self.m._rate_limiters.clear()
+
+    def client(self):
+        return self.m.create_ali_client() if self.is_ali else self.m.create_tx_client()
+
+    def run(self, scenario):
+        self.reset()
+        start = time.monotonic()
+        objects, nbytes = getattr(self, f'scenario_{scenario}')()
+        elapsed = max(time.monotonic() - start, 1e-9)
+        stages = self.m.metrics.snapshot()['stages']
+        status_save = stages.get('status_save', {})
+        return {
+            'objects': objects,
+            'bytes': nbytes,
+            'seconds': elapsed,
+            'objects_per_second': objects / elapsed,
+            'mb_per_second': nbytes / 1024 / 1024 / elapsed,
+            'peak_rss_mb': peak_rss_mb(),
+            'status_save_seconds': status_save.get('avg_seconds', 0) * status_save.get('count', 0),
+            'status_save_share': status_save.get('avg_seconds', 0) * status_save.get('count', 0) / elapsed,
+            'stages': stages,
+        }
+
+    def scenario_list(self):
+        count = sum(1 for _ in self.m.iter_source_objects(
+            self.client(), self.is_ali, parallel=self.args.parallel_listing, workers=self.args.workers
+        ))
+        return count, 0
+
+    def scenario_download(self):
+        status = self.m.FileStatus(self.args.source)
+        keys = (obj['key'] for obj in self.m.iter_source_objects(self.client(), self.is_ali))
+        succeeded, failed, nbytes = self.m.run_with_progress(
+            lambda key: _download(self.m, key, self.is_ali, status), keys, self.args.workers, "下载"
+        )
+        status.close()
+        return succeeded, nbytes
+
+    def scenario_upload(self):
+        ali_status = self.m.FileStatus('aliyun')
+        tx_status = self.m.FileStatus('tencent')
+        base_dir = os.path.join('downloads', self.args.source)
+        if not os.path.exists(base_dir):
+            self.scenario_download()
+            self.reset()
+        all_files = [
+            (self.args.source, os.path.relpath(path, base_dir), path)
+            for path, _ in self.m.iter_local_files(base_dir)
+        ]
+        before = len(self.minio.objects)
+        self.m.upload_all(all_files, ali_status, tx_status, self.minio, self.args.workers)
+        ali_status.close()
+        tx_status.close()
+        uploaded = len(self.minio.objects) - before
+        return uploaded, sum(os.path.getsize(path) for _, _, path in all_files)
+
+    def scenario_direct(self):
+        status = self.m.FileStatus(self.args.source + '_direct')
+        sizes = {obj['key']: obj['size'] for obj in self.m.iter_source_objects(self.client(), self.is_ali)}
+        succeeded, failed, nbytes = self.m.transfer_all(
+            list(sizes), self.is_ali, status, self.minio, self.args.workers, sizes=sizes
+        )
+        status.close()
+        return succeeded, nbytes
+
+    def scenario_status(self):
+        """只测状态存储：逐个mark_downloaded/mark_uploaded，再重新加载"""
+        status = self.m.FileStatus('status_bench')
+        for key, size in self.objects.items():
+            status.mark_downloaded(key, 'd41d8cd98f00b204e9800998ecf8427e', size)
+            status.mark_uploaded(key, 'd41d8cd98f00b204e9800998ecf8427e', size)
+        status.close()
+        start = time.monotonic()
+        reloaded = self.m.FileStatus('status_bench')
+        print(f"状态重新加载耗时: {time.monotonic() - start:.3f}s, "
+              f"{len(reloaded.status['uploaded'])} 条记录")
+        reloaded.close()
+        return len(self.objects) * 2, 0
+
+    def cleanup(self):
+        # 仍打开的状态会在退出时由atexit保存，先在临时目录中关闭，避免写到调用者的目录
+        for index in (self.m._hash_cache, self.m._content_index):
+            if index is not None:
+                index.store.close()
+        os.chdir(self.origin)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+def _download(m, key, is_ali, status):
+    success, path, file_hash, size = m.download_file(
+        m.get_thread_client(is_ali), key, is_ali, status, verbose=False
+    )
+    return success, size
+
+def print_results(results, baseline=None):
+    print("\n=== 基准测试结果 ===")
+    print(f"{'场景':<10}{'对象数':>10}{'耗时(s)':>10}{'个/s':>12}{'MB/s':>10}{'累计峰值RSS(MB)':>14}{'状态保存占比':>14}")
+    for scenario, result in results.items():
+        line = (f"{scenario:<10}{result['objects']:>10}{result['seconds']:>10.2f}"
+                f"{result['objects_per_second']:>12.1f}{result['mb_per_second']:>10.2f}"
+                f"{result['peak_rss_mb']:>14.1f}{result['status_save_share']:>13.1%}")
+        old = (baseline or {}).get(scenario)
+        if old and old['objects_per_second']:
+            change = result['objects_per_second'] / old['objects_per_second'] - 1
+            line += f"  ({change:+.1%} 个/s)"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='迁移工具离线基准测试')
+    parser.add_argument('--workload', choices=sorted(WORKLOADS), default='mixed')
+    parser.add_argument('--count', type=int, help='对象数量，默认使用负载预设')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=['list', 'download', 'upload'])
+    parser.add_argument('--source', choices=['aliyun', 'tencent'], default='aliyun')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--parallel-listing', action='store_true', help='按前缀并发列举')
+    parser.add_argument('--batch', action='store_true', help='小对象打包为tar上传')
+    parser.add_argument('--dedup', action='store_true', help='开启内容去重（后面的场景会复用前面场景的结果）')
+    parser.add_argument('--status-backend', choices=['journal', 'sqlite', 'json'], default='journal')
+    parser.add_argument('--latency-ms', type=float, default=0, help='源端每个请求的延迟')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0, help='源端带宽(Mbit/s)，0为不限')
+    parser.add_argument('--error-rate', type=float, default=0, help='源端500错误的概率')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='源端503 SlowDown的概率')
+    parser.add_argument('--minio-latency-ms', type=float, default=0)
+    parser.add_argument('--minio-bandwidth-mbps', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    parser.add_argument('--compare', help='与之前保存的结果JSON对比')
+    args = parser.parse_args()
+    # 基准测试在临时目录中运行，结果文件按启动时的当前目录解析
+    for name in ('output', 'compare'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    bench = Bench(args)
+    try:
+        results = {}
+        for scenario in args.scenarios:
+            print(f"\n--- 场景: {scenario} ---")
+            results[scenario] = bench.run(scenario)
+        print(f"\n源端请求数: {bench.source_link.requests}, 注入错误: {bench.source_link.injected_errors}, "
+              f"MinIO请求数: {bench.minio_link.requests}")
+    finally:
+        bench.cleanup()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
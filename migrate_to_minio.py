@@ -1,14 +1,31 @@
-import oss2
-from qcloud_cos import CosConfig
-from qcloud_cos import CosS3Client
-from minio import Minio
 import os
+import sys
+import shutil
+import socket
+import argparse
+import random
+import cProfile
+import pstats
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import hashlib
+import io
+import tarfile
 import json
-from datetime import datetime
+import time
+import atexit
+import sqlite3
+import threading
+import queue
+from contextlib import contextmanager
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from datetime import datetime, timezone
 from tqdm import tqdm
 import yaml
 
+# 各云厂商SDK和HTTP库在第一次创建客户端时才导入，导入本模块没有副作用，
+# 只用到一个来源时也不必加载其余SDK
+
 def load_config():
     """加载配置文件"""
     try:
@@ -19,259 +36,3235 @@ def load_config():
         print(f"加载配置文件失败: {str(e)}")
         return None
 
-# 加载配置
-config = load_config()
-if not config:
-    print("无法加载配置文件，程序退出")
-    exit(1)
-
-# 阿里云OSS配置
-ali_access_key = config['aliyun']['access_key']
-ali_access_secret = config['aliyun']['access_secret']
-ali_endpoint = config['aliyun']['endpoint']
-ali_bucket = config['aliyun']['bucket']
-
-# 腾讯云COS配置
-tx_secret_id = config['tencent']['secret_id']
-tx_secret_key = config['tencent']['secret_key']
-tx_region = config['tencent']['region']
-tx_bucket = config['tencent']['bucket']
-
-# MinIO配置
-minio_endpoint = config['minio']['endpoint']
-minio_access_key = config['minio']['access_key']
-minio_secret_key = config['minio']['secret_key']
-minio_bucket = config['minio']['bucket']
-minio_secure = config['minio']['secure']
+_config = None
+
+def get_config():
+    """第一次使用时加载配置文件，加载失败时退出"""
+    global _config
+    if _config is None:
+        config = load_config()
+        if not config:
+            print("无法加载配置文件，程序退出")
+            sys.exit(1)
+        _config = config
+    return _config
+
+def get_required(section, key):
+    """读取必需的配置项，缺失时提示并退出"""
+    try:
+        return get_config()[section][key]
+    except (KeyError, TypeError):
+        print(f"配置文件缺少 {section}.{key}，程序退出")
+        sys.exit(1)
+
+def get_setting(section, key, default=None):
+    """读取可选配置项，缺失时返回默认值"""
+    value = (get_config().get(section) or {}).get(key)
+    return default if value is None else value
+
+def write_json_atomic(path, data, indent=None):
+    """先写临时文件再替换，避免中断时留下半个JSON文件"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class Metrics:
+    """热点路径的耗时直方图、字节/对象计数和按类别统计的错误数
+
+    阶段包括 list / download / hash / status_save / upload / verify / transfer / dedup / batch。
+    """
+    # 直方图桶的上界(秒)
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.stages = {}    # {stage: {'count', 'sum', 'max', 'buckets'}}
+        self.bytes = {}     # {stage: 字节数}
+        self.objects = {}   # {stage: 对象数}
+        self.errors = {}    # {(stage, 错误类别): 次数}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {
+                    'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * (len(self.BUCKETS) + 1)
+                }
+            entry['count'] += 1
+            entry['sum'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+                    break
+            else:
+                entry['buckets'][-1] += 1
+
+    def add(self, stage, nbytes=0, objects=1):
+        with self.lock:
+            self.bytes[stage] = self.bytes.get(stage, 0) + nbytes
+            self.objects[stage] = self.objects.get(stage, 0) + objects
+
+    def record_error(self, stage, error_class):
+        with self.lock:
+            key = (stage, error_class)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    @contextmanager
+    def timer(self, stage):
+        """统计代码块耗时，抛出异常时按错误类别计数"""
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.record_error(stage, classify_error(e))
+            raise
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+    def _quantile(self, entry, fraction):
+        """根据直方图估算分位数（返回所在桶的上界）"""
+        target = entry['count'] * fraction
+        seen = 0
+        for bound, count in zip(self.BUCKETS, entry['buckets']):
+            seen += count
+            if seen >= target:
+                return bound
+        return entry['max']
+
+    def snapshot(self):
+        """当前统计的可JSON序列化快照"""
+        with self.lock:
+            elapsed = max(time.monotonic() - self.start, 1e-6)
+            stages = {
+                stage: {
+                    'count': entry['count'],
+                    'avg_seconds': entry['sum'] / entry['count'],
+                    'p50_seconds': self._quantile(entry, 0.5),
+                    'p95_seconds': self._quantile(entry, 0.95),
+                    'max_seconds': entry['max'],
+                    'bytes': self.bytes.get(stage, 0),
+                    'objects': self.objects.get(stage, 0),
+                    'bytes_per_second': self.bytes.get(stage, 0) / elapsed,
+                    'objects_per_second': self.objects.get(stage, 0) / elapsed
+                }
+                for stage, entry in self.stages.items()
+            }
+            errors = {f"{stage}:{error_class}": count for (stage, error_class), count in self.errors.items()}
+        return {
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'uptime_seconds': elapsed,
+            'stages': stages,
+            'errors': errors,
+            'concurrency': {name: limiter.stats() for name, limiter in list(_limiters.items())},
+            'hash_cache': _hash_cache.stats() if _hash_cache else None,
+            'dedup': _content_index.stats() if _content_index else None,
+            'connections': connection_stats()
+        }
+
+    def to_prometheus(self):
+        """Prometheus文本格式"""
+        lines = [
+            '# TYPE migrate_stage_seconds histogram',
+            '# TYPE migrate_bytes_total counter',
+            '# TYPE migrate_objects_total counter',
+            '# TYPE migrate_errors_total counter',
+            '# TYPE migrate_concurrency_window gauge',
+            '# TYPE migrate_connections_opened_total counter',
+            '# TYPE migrate_http_requests_total counter'
+        ]
+        with self.lock:
+            for stage, entry in self.stages.items():
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, entry['buckets']):
+                    cumulative += count
+                    lines.append(f'migrate_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'migrate_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {entry["count"]}')
+                lines.append(f'migrate_stage_seconds_sum{{stage="{stage}"}} {entry["sum"]}')
+                lines.append(f'migrate_stage_seconds_count{{stage="{stage}"}} {entry["count"]}')
+            for stage, value in self.bytes.items():
+                lines.append(f'migrate_bytes_total{{stage="{stage}"}} {value}')
+            for stage, value in self.objects.items():
+                lines.append(f'migrate_objects_total{{stage="{stage}"}} {value}')
+            for (stage, error_class), count in self.errors.items():
+                lines.append(f'migrate_errors_total{{stage="{stage}",class="{error_class}"}} {count}')
+        for name, limiter in list(_limiters.items()):
+            lines.append(f'migrate_concurrency_window{{endpoint="{name}"}} {limiter.window}')
+        for name, stats in connection_stats().items():
+            lines.append(f'migrate_connections_opened_total{{endpoint="{name}"}} {stats["opened"]}')
+            lines.append(f'migrate_http_requests_total{{endpoint="{name}"}} {stats["requests"]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """本地Prometheus抓取端点，只提供/metrics"""
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_reporter():
+    """按配置定期把统计写入JSON文件，并可选启动Prometheus端点"""
+    stats_file = get_setting('metrics', 'stats_file', 'migration_stats.json')
+    interval = get_setting('metrics', 'interval', 10)
+    port = get_setting('metrics', 'prometheus_port', 0)
+
+    def flush():
+        try:
+            write_json_atomic(stats_file, metrics.snapshot(), indent=2)
+        except Exception as e:
+            print(f"写入统计文件失败: {str(e)}")
+
+    def report():
+        while True:
+            time.sleep(interval)
+            flush()
+
+    if stats_file:
+        threading.Thread(target=report, name='metrics-reporter', daemon=True).start()
+        atexit.register(flush)
+    if port:
+        server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        print(f"Prometheus指标: http://127.0.0.1:{port}/metrics")
+
+def run_profiled(func, *args):
+    """metrics.profile开启或设置了MIGRATE_PROFILE环境变量时，用cProfile运行func并保存结果
+
+    cProfile只记录调用enable的线程，而下载、上传都在线程池和流水线线程中执行，
+    因此通过threading.setprofile为之后启动的每个线程各建一个profiler，结束时合并保存
+    （Python 3.12起cProfile本身覆盖所有线程，不再另建）。
+    结果可用 python -m pstats 或 snakeviz 查看；线程都有名字，便于 py-spy dump 对照。
+    """
+    if not (get_setting('metrics', 'profile', False) or os.environ.get('MIGRATE_PROFILE')):
+        return func(*args)
+    profile_file = get_setting('metrics', 'profile_file', 'migration.prof')
+    profilers = [cProfile.Profile()]
+    profilers_lock = threading.Lock()
+
+    def profile_thread(frame, event, arg):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 已有的profiler覆盖了所有线程
+            sys.setprofile(None)
+            return
+        with profilers_lock:
+            profilers.append(profiler)
+
+    threading.setprofile(profile_thread)
+    profilers[0].enable()
+    try:
+        return func(*args)
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+        stats = None
+        with profilers_lock:
+            for profiler in profilers:
+                try:
+                    stats = stats.add(profiler) if stats else pstats.Stats(profiler)
+                except TypeError:
+                    # 没有采集到任何调用的线程
+                    continue
+        if stats:
+            stats.dump_stats(profile_file)
+        print(f"性能分析结果已保存到 {profile_file}（合并了 {len(profilers)} 个线程）")
+
+class JsonStatusBackend:
+    """旧版状态后端：每次提交都重写整个JSON文件"""
+    def __init__(self, base_path):
+        self.status_file = base_path + '_status.json'
+
+    def load(self):
+        if os.path.exists(self.status_file):
+            with open(self.status_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return None
+
+    def commit(self, changes, status):
+        write_json_atomic(self.status_file, status, indent=2)
+
+    def close(self):
+        pass
+
+class JournalStatusBackend:
+    """追加写日志后端：变更追加到journal，条目过多时压缩成快照
+
+    快照沿用 <source>_status.json 的格式，因此旧的状态文件可直接作为快照导入。
+    """
+    def __init__(self, base_path, compact_threshold=50000):
+        self.status_file = base_path + '_status.json'
+        self.journal_file = base_path + '_status.journal'
+        self.compact_threshold = compact_threshold
+        self.journal_entries = 0
+        self.journal = None
+
+    def load(self):
+        status = None
+        if os.path.exists(self.status_file):
+            with open(self.status_file, 'r', encoding='utf-8') as f:
+                status = json.load(f)
+        if os.path.exists(self.journal_file):
+            status = status or {}
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        section, key, value = json.loads(line)
+                    except ValueError:
+                        # 进程中断时最后一行可能不完整，直接忽略
+                        continue
+                    if value is None:
+                        status.get(section, {}).pop(key, None)
+                    else:
+                        status.setdefault(section, {})[key] = value
+                    self.journal_entries += 1
+        return status
+
+    def commit(self, changes, status):
+        if self.journal is None:
+            self.journal = open(self.journal_file, 'a', encoding='utf-8')
+        self.journal.write(''.join(
+            json.dumps(change, ensure_ascii=False) + '\n' for change in changes
+        ))
+        self.journal.flush()
+        self.journal_entries += len(changes)
+        if self.journal_entries >= self.compact_threshold:
+            self.compact(status)
+
+    def compact(self, status):
+        """把当前状态写成快照并清空journal"""
+        write_json_atomic(self.status_file, status)
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_file, 'w', encoding='utf-8')
+        self.journal_entries = 0
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+class SqliteStatusBackend:
+    """SQLite(WAL模式)状态后端，首次使用时导入旧的JSON状态文件"""
+    def __init__(self, base_path):
+        self.status_file = base_path + '_status.db'
+        self.legacy_file = base_path + '_status.json'
+        self.db = sqlite3.connect(self.status_file, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'section TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+            'PRIMARY KEY (section, key)) WITHOUT ROWID'
+        )
+
+    def load(self):
+        rows = self.db.execute('SELECT section, key, value FROM entries').fetchall()
+        if not rows:
+            if os.path.exists(self.legacy_file):
+                with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                    status = json.load(f)
+                self.commit([
+                    (section, key, value)
+                    for section, entries in status.items()
+                    for key, value in entries.items()
+                ], status)
+                return status
+            return None
+        status = {}
+        for section, key, value in rows:
+            status.setdefault(section, {})[key] = json.loads(value)
+        return status
+
+    def commit(self, changes, status):
+        with self.db:
+            for section, key, value in changes:
+                if value is None:
+                    self.db.execute(
+                        'DELETE FROM entries WHERE section = ? AND key = ?', (section, key)
+                    )
+                else:
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO entries (section, key, value) VALUES (?, ?, ?)',
+                        (section, key, json.dumps(value, ensure_ascii=False))
+                    )
+
+    def close(self):
+        self.db.close()
+
+def create_status_backend(base_path, backend=None):
+    """根据配置创建状态存储后端"""
+    backend = backend or get_setting('status', 'backend', 'journal')
+    if backend == 'json':
+        return JsonStatusBackend(base_path)
+    if backend == 'sqlite':
+        return SqliteStatusBackend(base_path)
+    if backend == 'journal':
+        return JournalStatusBackend(
+            base_path, get_setting('status', 'compact_threshold', 50000)
+        )
+    raise ValueError(f"未知的状态存储后端: {backend}")
+
+class FileStatus:
+    def __init__(self, source_path, backend=None):
+        self.backend = create_status_backend(source_path, backend)
+        self.status_file = self.backend.status_file
+        self.batch_size = get_setting('status', 'batch_size', 500)
+        self.batch_interval = get_setting('status', 'batch_interval', 5)
+        self.pending = []
+        self.last_commit = time.monotonic()
+        self.closed = False
+        # 多个下载线程共享同一个状态对象，变更和提交需要加锁
+        self.lock = threading.RLock()
+        self.load_status()
+        atexit.register(self.close)
+
+    def load_status(self):
+        self.status = self.backend.load() or {}
+        # {file_key: {'hash': 'xxx', 'size': 123, 'time': 'xxx'}}
+        self.status.setdefault('downloaded', {})
+        # {file_key: {'hash': 'xxx', 'time': 'xxx'}}
+        self.status.setdefault('uploaded', {})
+        # {file_key: {'error': 'xxx', 'time': 'xxx'}}
+        self.status.setdefault('failed', {})
+
+    def save_status(self):
+        """立即提交所有未保存的变更"""
+        with self.lock:
+            if self.pending:
+                changes, self.pending = self.pending, []
+                with metrics.timer('status_save'):
+                    self.backend.commit(changes, self.status)
+                metrics.add('status_save', objects=len(changes))
+            self.last_commit = time.monotonic()
+
+    def record(self, section, file_key, value):
+        """记录一条状态变更，value为None表示删除，按条数或时间批量提交"""
+        with self.lock:
+            if value is None:
+                self.status.setdefault(section, {}).pop(file_key, None)
+            else:
+                self.status.setdefault(section, {})[file_key] = value
+            self.pending.append((section, file_key, value))
+            if (len(self.pending) >= self.batch_size
+                    or time.monotonic() - self.last_commit >= self.batch_interval):
+                self.save_status()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.save_status()
+            self.backend.close()
+            self.closed = True
+
+    def mark_downloaded(self, file_key, file_hash, file_size, fingerprint=None):
+        info = {
+            'hash': file_hash,
+            'size': file_size,
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        if fingerprint:
+            info['fingerprint'] = fingerprint
+        self.record('downloaded', file_key, info)
+        failed = self.status['failed'].get(file_key)
+        if failed and failed.get('stage', 'download') == 'download':
+            self.record('failed', file_key, None)
+
+    def mark_uploaded(self, file_key, file_hash, file_size=None, etag=None):
+        info = {
+            'hash': file_hash,
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        if file_size is not None:
+            info['size'] = file_size
+        if etag:
+            info['etag'] = normalize_etag(etag)
+        self.record('uploaded', file_key, info)
+        if file_key in self.status['failed']:
+            self.record('failed', file_key, None)
+
+    def mark_failed(self, file_key, error, stage='download'):
+        """记录失败，累计尝试次数并按指数退避计算下次可重试的时间"""
+        previous = self.status['failed'].get(file_key) or {}
+        attempts = previous.get('attempts', 0) + 1
+        self.record('failed', file_key, {
+            'error': str(error),
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'stage': stage,
+            'class': classify_error(error),
+            'attempts': attempts,
+            'next_retry': time.time() + backoff_delay(attempts)
+        })
+
+# 读写文件和网络流时使用的缓冲区大小
+BUFFER_SIZE = 1024 * 1024
+
+def get_file_hash(filepath):
+    """计算文件的MD5值"""
+    hash_md5 = hashlib.md5()
+    size = 0
+    with metrics.timer('hash'), open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), b""):
+            hash_md5.update(chunk)
+            size += len(chunk)
+    metrics.add('hash', size)
+    return hash_md5.hexdigest()
+
+def get_fingerprint(stat_result):
+    """文件指纹：大小、修改时间(纳秒)和inode，任一变化都视为文件已改变"""
+    return [stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino]
+
+class HashCache:
+    """按(路径, 大小, mtime_ns, inode)持久化缓存文件MD5，文件未变化时不重新计算"""
+    def __init__(self, base_path='hash_cache'):
+        self.store = FileStatus(base_path)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_path):
+        """返回(大小, MD5)，指纹未变化时直接使用缓存"""
+        file_path = os.path.normpath(file_path)
+        fingerprint = get_fingerprint(os.stat(file_path))
+        entry = self.store.status.setdefault('files', {}).get(file_path)
+        if entry and entry['fingerprint'] == fingerprint:
+            self.hits += 1
+            return fingerprint[0], entry['hash']
+        self.misses += 1
+        file_hash = get_file_hash(file_path)
+        self.put(file_path, file_hash)
+        return fingerprint[0], file_hash
+
+    def put(self, file_path, file_hash):
+        """记录已知的文件MD5，例如下载时边写边算出的hash，返回文件指纹"""
+        file_path = os.path.normpath(file_path)
+        fingerprint = get_fingerprint(os.stat(file_path))
+        self.store.record('files', file_path, {
+            'fingerprint': fingerprint,
+            'hash': file_hash
+        })
+        return fingerprint
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+_hash_cache = None
+_hash_cache_lock = threading.Lock()
+
+def get_hash_cache():
+    """获取全局哈希缓存，首次使用时加载"""
+    global _hash_cache
+    with _hash_cache_lock:
+        if _hash_cache is None:
+            _hash_cache = HashCache()
+        return _hash_cache
+
+# 服务端复制单个对象的大小上限(5GiB)
+COPY_OBJECT_LIMIT = 5 * 1024 * 1024 * 1024
+
+class ContentIndex:
+    """按内容MD5去重的索引，阿里云和腾讯云共享
+
+    downloaded记录每个MD5第一个下载到本地的文件，uploaded记录第一个写入MinIO的key，
+    etags记录不是内容MD5的源端ETag(加大小)对应的MD5——例如分片上传或KMS加密的对象，迁移过一次后才知道。
+    重复内容的本地文件用硬链接生成，MinIO对象用服务端copy_object生成。
+    """
+    def __init__(self, base_path='content_index'):
+        self.store = FileStatus(base_path)
+        self.store.status.setdefault('etags', {})
+        self.lock = threading.Lock()
+        self.linked = 0
+        self.copied = 0
+        self.saved_bytes = 0
+
+    def resolve(self, etag, size, content_md5=None):
+        """由源端ETag和大小推断内容MD5，无法推断时返回None
+
+        content_md5为source_content_md5()确认可信的源端MD5，其余ETag只能查之前迁移时的记录。
+        """
+        if content_md5:
+            return content_md5
+        if not etag:
+            return None
+        return self.store.status['etags'].get(f"{normalize_etag(etag)}:{size}")
+
+    def remember(self, section, file_hash, value, source_etag=None):
+        """记录内容的第一个副本，已有记录时保留原记录"""
+        if file_hash not in self.store.status[section]:
+            self.store.record(section, file_hash, value)
+        if source_etag and normalize_etag(source_etag) != file_hash:
+            etag_key = f"{normalize_etag(source_etag)}:{value['size']}"
+            if etag_key not in self.store.status['etags']:
+                self.store.record('etags', etag_key, file_hash)
+
+    def add_downloaded(self, file_hash, file_path, size, source_etag=None):
+        self.remember('downloaded', file_hash, {'path': file_path, 'size': size}, source_etag)
+
+    def add_uploaded(self, file_hash, file_key, size, source_etag=None):
+        self.remember('uploaded', file_hash, {'key': file_key, 'size': size}, source_etag)
+
+    def _saved(self, counter, size):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.saved_bytes += size
+        metrics.add('dedup', size)
+
+    def link_duplicate(self, file_hash, size, file_path):
+        """本地已有相同内容的文件时硬链接（跨设备时复制）到file_path，返回是否成功"""
+        entry = self.store.status['downloaded'].get(file_hash)
+        if not entry or entry['size'] != size:
+            return False
+        existing = entry['path']
+        if os.path.normpath(existing) == os.path.normpath(file_path):
+            return False
+        try:
+            if os.path.getsize(existing) != size:
+                raise FileNotFoundError(existing)
+        except OSError:
+            # 原文件已被删除或修改（例如流水线上传后清理），不再作为去重来源
+            self.store.record('downloaded', file_hash, None)
+            return False
+        tmp_path = file_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            try:
+                os.link(existing, tmp_path)
+            except OSError:
+                shutil.copyfile(existing, tmp_path)
+        except FileNotFoundError:
+            # 检查之后原文件被删除（例如流水线上传后清理），改为正常下载
+            self.store.record('downloaded', file_hash, None)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, file_path)
+        self._saved('linked', size)
+        return True
+
+    def copy_duplicate(self, minio_client, file_hash, size, file_key):
+        """MinIO中已有相同内容的对象时用服务端复制生成file_key，返回新对象的ETag，无法去重时返回None
+
+        复制前用stat_object确认源对象的大小和MD5（ETag或元数据）。
+        """
+        entry = self.store.status['uploaded'].get(file_hash)
+        if not entry or entry['size'] != size or size > COPY_OBJECT_LIMIT:
+            return None
+        try:
+            stat = minio_client.stat_object(get_required('minio', 'bucket'), entry['key'])
+            confirmed = stat.size == size and file_hash in (
+                normalize_etag(stat.etag), get_metadata_value(stat.metadata, MD5_METADATA_KEY)
+            )
+        except Exception:
+            confirmed = False
+        if not confirmed:
+            self.store.record('uploaded', file_hash, None)
+            return None
+        if entry['key'] == file_key:
+            return stat.etag
+        from minio.commonconfig import CopySource
+        with metrics.timer('dedup'):
+            result = minio_client.copy_object(
+                get_required('minio', 'bucket'), file_key, CopySource(get_required('minio', 'bucket'), entry['key'])
+            )
+        self._saved('copied', size)
+        return result.etag
+
+    def stats(self):
+        return {
+            'contents': len(self.store.status['uploaded']),
+            'linked': self.linked,
+            'copied': self.copied,
+            'saved_bytes': self.saved_bytes
+        }
+
+_content_index = None
+_content_index_lock = threading.Lock()
+
+def get_content_index():
+    """获取全局内容去重索引，未开启去重时返回None"""
+    global _content_index
+    if not get_setting('dedup', 'enabled', True):
+        return None
+    with _content_index_lock:
+        if _content_index is None:
+            _content_index = ContentIndex()
+        return _content_index
+
+def get_upload_settings():
+    """返回(分片大小, 单文件并发分片数, 并发上传文件数)"""
+    return (
+        get_setting('upload', 'part_size', 16 * 1024 * 1024),
+        get_setting('upload', 'parallel_parts', 4),
+        get_setting('upload', 'workers', 8)
+    )
+
+def get_connection_settings():
+    """返回(每个端点的连接池大小, TCP keep-alive空闲秒数)，空闲秒数为0时不开启keep-alive探测"""
+    _, parallel_parts, workers = get_upload_settings()
+    return (
+        get_setting('connections', 'pool_size', workers * parallel_parts),
+        get_setting('connections', 'keepalive_idle', 60)
+    )
+
+def get_socket_options():
+    """开启TCP keep-alive，避免空闲连接被NAT/负载均衡断开后重新握手"""
+    import urllib3
+    options = list(urllib3.connection.HTTPConnection.default_socket_options)
+    _, idle = get_connection_settings()
+    if idle:
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle))
+    return options
+
+def create_keepalive_adapter(pool_size):
+    """创建带TCP keep-alive选项的requests连接适配器"""
+    import requests
+
+    class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            kwargs['socket_options'] = get_socket_options()
+            super().init_poolmanager(*args, **kwargs)
+
+    return KeepAliveAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+# 各端点共享的连接池：所有线程的客户端复用同一批连接
+_pools = {}
+_pools_lock = threading.Lock()
+
+def build_pool(name):
+    """创建端点的连接池：阿里云为oss2.Session，腾讯云为requests会话，MinIO为urllib3 PoolManager"""
+    pool_size, _ = get_connection_settings()
+    if name == 'minio':
+        import certifi
+        import urllib3
+        return urllib3.PoolManager(
+            timeout=urllib3.Timeout(connect=300, read=300),
+            maxsize=pool_size,
+            socket_options=get_socket_options(),
+            cert_reqs='CERT_REQUIRED',
+            ca_certs=os.environ.get('SSL_CERT_FILE') or certifi.where(),
+            retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+        )
+    if name == 'aliyun':
+        import oss2
+        pool = oss2.Session(pool_size=pool_size)
+        session = pool.session
+    else:
+        import requests
+        pool = session = requests.Session()
+    adapter = create_keepalive_adapter(pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return pool
+
+def get_shared_pool(name):
+    """获取端点共享的连接池，首次使用时创建"""
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = _pools[name] = build_pool(name)
+        return pool
+
+def iter_connection_pools(pool):
+    """遍历连接池下每个主机的urllib3 HTTPConnectionPool"""
+    session = getattr(pool, 'session', pool)
+    if hasattr(session, 'adapters'):
+        managers = {id(adapter.poolmanager): adapter.poolmanager for adapter in session.adapters.values()
+                    if getattr(adapter, 'poolmanager', None)}.values()
+    else:
+        managers = [pool]
+    for manager in managers:
+        for key in list(manager.pools.keys()):
+            host_pool = manager.pools.get(key)
+            if host_pool is not None:
+                yield host_pool
+
+def connection_stats():
+    """各端点新建的连接数和发出的请求数，新建连接远少于请求数说明连接被复用"""
+    stats = {}
+    for name, pool in list(_pools.items()):
+        opened = sent = 0
+        for host_pool in iter_connection_pools(pool):
+            opened += host_pool.num_connections
+            sent += host_pool.num_requests
+        stats[name] = {
+            'opened': opened,
+            'requests': sent,
+            'reuse_ratio': 1 - opened / sent if sent else 0
+        }
+    return stats
+
+def create_ali_client():
+    """创建阿里云OSS客户端，共享连接池"""
+    import oss2
+    auth = oss2.Auth(get_required('aliyun', 'access_key'), get_required('aliyun', 'access_secret'))
+    return oss2.Bucket(
+        auth, get_required('aliyun', 'endpoint'), get_required('aliyun', 'bucket'),
+        session=get_shared_pool('aliyun')
+    )
+
+def create_tx_client():
+    """创建腾讯云COS客户端，共享连接池"""
+    from qcloud_cos import CosConfig, CosS3Client
+    pool_size, _ = get_connection_settings()
+    config = CosConfig(
+        Region=get_required('tencent', 'region'),
+        SecretId=get_required('tencent', 'secret_id'),
+        SecretKey=get_required('tencent', 'secret_key'),
+        KeepAlive=True, PoolConnections=pool_size, PoolMaxSize=pool_size
+    )
+    return CosS3Client(config, session=get_shared_pool('tencent'))
+
+def create_minio_client():
+    """创建MinIO客户端，共享连接池"""
+    from minio import Minio
+    return Minio(
+        get_required('minio', 'endpoint'),
+        access_key=get_required('minio', 'access_key'),
+        secret_key=get_required('minio', 'secret_key'),
+        secure=get_required('minio', 'secure'),
+        http_client=get_shared_pool('minio')
+    )
+
+class LazyClient:
+    """第一次访问属性时才创建的客户端，用不到的来源不会导入SDK或建立连接"""
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return getattr(self._client, name)
+
+def create_source_client(source):
+    """按来源名称创建延迟初始化的源端客户端"""
+    return LazyClient(create_ali_client if source == 'aliyun' else create_tx_client)
+
+_thread_local = threading.local()
+
+def get_thread_client(is_ali=True):
+    """获取当前线程专属的源端客户端，首次使用时创建，各线程的客户端共享同一个连接池"""
+    name = 'ali_client' if is_ali else 'tx_client'
+    client = getattr(_thread_local, name, None)
+    if client is None:
+        client = create_ali_client() if is_ali else create_tx_client()
+        setattr(_thread_local, name, client)
+    return client
+
+# 视为限流的错误码，出现时并发窗口减半
+THROTTLE_ERROR_CODES = {
+    'SlowDown', 'Throttling', 'TooManyRequests', 'RequestLimitExceeded',
+    'ServiceUnavailable', 'QpsLimitExceeded', 'ReqLimitExceeded'
+}
+
+def get_error_status(error):
+    """从各SDK的异常中取出HTTP状态码，取不到时返回None"""
+    for attr in ('status', 'status_code'):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    getter = getattr(error, 'get_status_code', None)
+    if getter:
+        try:
+            return int(getter())
+        except (TypeError, ValueError):
+            return None
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status', None)
+
+def get_error_code(error):
+    """从各SDK的异常中取出错误码（如SlowDown），取不到时返回None"""
+    code = getattr(error, 'code', None)
+    if isinstance(code, str):
+        return code
+    getter = getattr(error, 'get_error_code', None)
+    return getter() if getter else None
+
+def is_throttle_error(error):
+    """判断是否为服务端限流（503/429/SlowDown）"""
+    return get_error_status(error) in (429, 503) or get_error_code(error) in THROTTLE_ERROR_CODES
+
+class AdaptiveLimiter:
+    """按AIMD调整单个端点的并发窗口
+
+    每完成一个窗口数量的请求算一轮：本轮有请求因窗口已满而等待、且吞吐不低于上一轮的95%时窗口+1，
+    吞吐下降且平均延迟上升超过50%时窗口-1；遇到限流错误时窗口减半，
+    同一批在途请求触发的限流只减一次。本轮没有请求等待时（线程池比窗口小）窗口不增长，
+    而是收缩到本轮实际的最大并发，这样限流时减半能立即生效。
+    """
+    def __init__(self, name, initial, minimum=1, maximum=64):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = max(minimum, min(initial, maximum))
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.last_decrease = 0
+        self.last_throughput = None
+        self.last_latency = None
+        self.throttled = 0
+        self.completed = 0
+        self._reset_epoch(time.monotonic())
+
+    def _reset_epoch(self, now):
+        self.epoch_start = now
+        self.epoch_done = 0
+        self.epoch_bytes = 0
+        self.epoch_latency = 0.0
+        self.epoch_saturated = False
+        self.epoch_peak = self.in_flight
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.window:
+                self.epoch_saturated = True
+                self.cond.wait()
+            self.in_flight += 1
+            self.epoch_peak = max(self.epoch_peak, self.in_flight)
+
+    def release(self, start, nbytes=0, error=None):
+        """归还并发槽位，根据本次请求的结果调整窗口"""
+        now = time.monotonic()
+        with self.cond:
+            self.in_flight -= 1
+            if error is not None and is_throttle_error(error):
+                self.throttled += 1
+                if start >= self.last_decrease:
+                    self.window = max(self.minimum, self.window // 2)
+                    self.last_decrease = now
+                    self._reset_epoch(now)
+            elif error is None:
+                self.completed += 1
+                self.epoch_done += 1
+                self.epoch_bytes += nbytes
+                self.epoch_latency += now - start
+                if self.epoch_done >= self.window:
+                    self._adjust(now)
+            self.cond.notify_all()
+
+    def _adjust(self, now):
+        elapsed = max(now - self.epoch_start, 1e-6)
+        throughput = (self.epoch_bytes or self.epoch_done) / elapsed
+        latency = self.epoch_latency / self.epoch_done
+        if not self.epoch_saturated:
+            self.window = max(self.minimum, min(self.window, self.epoch_peak))
+        elif self.last_throughput is None or throughput >= self.last_throughput * 0.95:
+            self.window = min(self.maximum, self.window + 1)
+        elif self.last_latency and latency > self.last_latency * 1.5:
+            self.window = max(self.minimum, self.window - 1)
+        self.last_throughput = throughput
+        self.last_latency = latency
+        self._reset_epoch(now)
+
+    @contextmanager
+    def slot(self):
+        """占用一个并发槽位，调用方可在返回的dict中写入传输的字节数"""
+        self.acquire()
+        start = time.monotonic()
+        result = {'bytes': 0}
+        try:
+            yield result
+        except Exception as e:
+            self.release(start, result['bytes'], e)
+            raise
+        else:
+            self.release(start, result['bytes'])
+
+    def stats(self):
+        return {
+            'window': self.window,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'throttled': self.throttled
+        }
+
+class TokenBucket:
+    """令牌桶限速，rate为每秒字节数，0表示不限速"""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # 允许透支，透支的部分通过等待补回
+            self.tokens -= nbytes
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_time:
+            time.sleep(wait_time)
+
+class ThrottledReader:
+    """读取时按令牌桶限速的流包装"""
+    def __init__(self, stream, *buckets):
+        self.stream = stream
+        self.buckets = [bucket for bucket in buckets if bucket.rate]
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        for bucket in self.buckets:
+            bucket.consume(len(data))
+        return data
+
+_limiters = {}
+_rate_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(endpoint):
+    """获取端点(aliyun/tencent/minio)的自适应并发控制器"""
+    with _limiters_lock:
+        if endpoint not in _limiters:
+            settings = get_setting('throttle', endpoint, {})
+            if endpoint == 'minio':
+                initial = get_upload_settings()[2]
+            else:
+                initial = get_setting('transfer', f'{endpoint}_workers', 8)
+            _limiters[endpoint] = AdaptiveLimiter(
+                endpoint,
+                settings.get('initial_concurrency', initial),
+                settings.get('min_concurrency', 1),
+                settings.get('max_concurrency', 64)
+            )
+        return _limiters[endpoint]
+
+def get_rate_limiter(endpoint):
+    """获取端点的带宽限速令牌桶"""
+    with _limiters_lock:
+        if endpoint not in _rate_limiters:
+            settings = get_setting('throttle', endpoint, {})
+            _rate_limiters[endpoint] = TokenBucket(settings.get('bytes_per_second', 0))
+        return _rate_limiters[endpoint]
+
+def limiter_summary():
+    """当前各端点的并发窗口，用于进度条显示"""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return ' '.join(f"{limiter.name}={limiter.window}" for limiter in limiters)
+
+# 这些HTTP状态码重试也不会成功
+PERMANENT_STATUS_CODES = {400, 401, 403, 404, 405, 409, 411, 412, 416}
+
+def classify_error(error):
+    """把错误分为transient(可重试)和permanent(重试无意义)两类
+
+    只有错误信息字符串（例如校验失败）时视为可重试。
+    """
+    if isinstance(error, str):
+        return 'transient'
+    if is_throttle_error(error):
+        return 'transient'
+    status = get_error_status(error)
+    if isinstance(status, int) and status > 0:
+        return 'permanent' if status in PERMANENT_STATUS_CODES else 'transient'
+    if get_error_code(error) in ('NoSuchKey', 'AccessDenied', 'NoSuchBucket', 'InvalidAccessKeyId'):
+        return 'permanent'
+    if isinstance(error, (FileNotFoundError, PermissionError, ValueError, TypeError)):
+        return 'permanent'
+    return 'transient'
+
+def backoff_delay(attempts):
+    """带完全抖动的指数退避：在[0, min(上限, 基数*2^(n-1))]内随机取值"""
+    base = get_setting('retry', 'base_delay', 1)
+    cap = get_setting('retry', 'max_delay', 300)
+    return random.uniform(0, min(cap, base * 2 ** (attempts - 1)))
+
+def call_with_retry(func, *args):
+    """调用func，遇到可重试的错误时按指数退避重试，最多retry.inline_attempts次"""
+    attempts = get_setting('retry', 'inline_attempts', 3)
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(*args)
+        except Exception as e:
+            if attempt >= attempts or classify_error(e) == 'permanent':
+                raise
+            time.sleep(backoff_delay(attempt))
+
+def init_clients():
+    """准备所有客户端，SDK导入和连接在第一次使用时才进行"""
+    return LazyClient(create_ali_client), LazyClient(create_tx_client), LazyClient(create_minio_client)
+
+# 每页最多返回的对象数（OSS/COS允许的最大值）
+LIST_PAGE_SIZE = 1000
+
+def parse_last_modified(value):
+    """把OSS的时间戳或COS的ISO时间统一转换为epoch秒"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S').replace(
+        tzinfo=timezone.utc
+    ).timestamp()
+
+def make_object_info(key, size, etag, last_modified):
+    """列表中每个对象的元数据"""
+    return {
+        'key': key,
+        'size': int(size),
+        'etag': normalize_etag(etag),
+        'last_modified': parse_last_modified(last_modified)
+    }
+
+def list_source_page(client, is_ali, prefix='', marker='', delimiter=''):
+    """列出一页对象，返回(对象列表, 公共前缀列表, 下一页marker，没有下一页时为None)"""
+    if is_ali:
+        result = client.list_objects(
+            prefix=prefix, delimiter=delimiter, marker=marker, max_keys=LIST_PAGE_SIZE
+        )
+        objects = [
+            make_object_info(obj.key, obj.size, obj.etag, obj.last_modified)
+            for obj in result.object_list
+        ]
+        next_marker = result.next_marker if result.is_truncated else None
+        return objects, list(result.prefix_list), next_marker
+    response = client.list_objects(
+        Bucket=get_required('tencent', 'bucket'), Prefix=prefix, Delimiter=delimiter, Marker=marker, MaxKeys=LIST_PAGE_SIZE
+    )
+    objects = [
+        make_object_info(content['Key'], content['Size'], content['ETag'], content['LastModified'])
+        for content in response.get('Contents', [])
+    ]
+    prefixes = [item['Prefix'] for item in response.get('CommonPrefixes', [])]
+    next_marker = response.get('NextMarker') if response['IsTruncated'] == 'true' else None
+    return objects, prefixes, next_marker
+
+def iter_source_pages(client, is_ali, prefix='', delimiter='', marker=''):
+    """按页产出(对象列表, 公共前缀列表)，跳过以'/'结尾的目录对象；marker不为空时从该key之后开始列举"""
+    while True:
+        with metrics.timer('list'):
+            objects, prefixes, marker = list_source_page(client, is_ali, prefix, marker, delimiter)
+        metrics.add('list', objects=len(objects))
+        yield [obj for obj in objects if not obj['key'].endswith('/')], prefixes
+        if marker is None:
+            break
+
+def _put_until_stopped(q, item, stop):
+    """向有界队列放入数据，消费者已停止时放弃"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def iter_source_objects(client, is_ali=True, parallel=None, workers=None):
+    """边列举边产出源端对象元数据，开启parallel时按顶层前缀并发列举
+
+    并发模式先用delimiter列出根目录下的对象和顶层前缀，再由线程池分别列举
+    每个前缀，各页到达后立即产出，产出顺序不再按key排序。
+    """
+    if parallel is None:
+        parallel = get_setting('listing', 'parallel_prefixes', False)
+    if not parallel:
+        for objects, _ in iter_source_pages(client, is_ali):
+            yield from objects
+        return
+
+    workers = workers or get_setting('listing', 'workers', 8)
+    prefixes = []
+    for objects, page_prefixes in iter_source_pages(client, is_ali, delimiter='/'):
+        yield from objects
+        prefixes.extend(page_prefixes)
+    if not prefixes:
+        return
+
+    pages = queue.Queue(maxsize=workers * 4)
+    stop = threading.Event()
+
+    def list_prefix(prefix):
+        try:
+            for objects, _ in iter_source_pages(get_thread_client(is_ali), is_ali, prefix):
+                if not _put_until_stopped(pages, objects, stop):
+                    return
+        except Exception as e:
+            _put_until_stopped(pages, e, stop)
+        finally:
+            _put_until_stopped(pages, None, stop)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='list') as executor:
+        for prefix in prefixes:
+            executor.submit(list_prefix, prefix)
+        try:
+            remaining = len(prefixes)
+            while remaining:
+                page = pages.get()
+                if page is None:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield from page
+        finally:
+            stop.set()
+
+def get_source_files(client, is_ali=True):
+    """获取源端的文件key列表"""
+    name, service = ('阿里云', 'OSS') if is_ali else ('腾讯云', 'COS')
+    print(f"\n正在获取{name}{service}文件列表...")
+    try:
+        files = [obj['key'] for obj in iter_source_objects(client, is_ali)]
+        print(f"找到 {len(files)} 个文件")
+        return files
+    except Exception as e:
+        print(f"获取{name}文件列表失败: {str(e)}")
+        return []
+
+def get_ali_files(ali_client):
+    """获取阿里云OSS的文件列表"""
+    return get_source_files(ali_client, True)
+
+def get_tx_files(tx_client):
+    """获取腾讯云COS的文件列表"""
+    return get_source_files(tx_client, False)
+
+class ListingCache:
+    """源端文件列表的本地SQLite缓存
+
+    每个来源的对象按列举顺序编号(seq)保存，菜单按编号分页和选择，
+    前缀过滤走(source, key)索引，通配符过滤使用GLOB。
+    """
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(
+            'PRAGMA journal_mode=WAL;'
+            'CREATE TABLE IF NOT EXISTS listing (source TEXT, seq INTEGER, key TEXT, size INTEGER, '
+            'etag TEXT, last_modified REAL, PRIMARY KEY (source, seq)) WITHOUT ROWID;'
+            'CREATE INDEX IF NOT EXISTS listing_key ON listing (source, key);'
+            'CREATE TABLE IF NOT EXISTS listing_meta (source TEXT PRIMARY KEY, refreshed REAL, count INTEGER);'
+        )
+
+    def age(self, source):
+        """缓存距上次刷新的秒数，没有缓存时返回None"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT refreshed FROM listing_meta WHERE source = ?', (source,)
+            ).fetchone()
+        return time.time() - row[0] if row else None
+
+    def is_fresh(self, source):
+        age = self.age(source)
+        return age is not None and age < self.ttl
+
+    def refresh(self, client, is_ali):
+        """重新列举源端并整体替换缓存，返回对象数"""
+        source = 'aliyun' if is_ali else 'tencent'
+        count = 0
+        batch = []
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM listing WHERE source = ?', (source,))
+            with tqdm(desc="列举", unit='个') as progress:
+                for obj in iter_source_objects(client, is_ali):
+                    batch.append((source, count, obj['key'], obj['size'], obj['etag'], obj['last_modified']))
+                    count += 1
+                    if len(batch) >= LIST_PAGE_SIZE:
+                        self.conn.executemany('INSERT INTO listing VALUES (?, ?, ?, ?, ?, ?)', batch)
+                        progress.update(len(batch))
+                        batch = []
+                self.conn.executemany('INSERT INTO listing VALUES (?, ?, ?, ?, ?, ?)', batch)
+                progress.update(len(batch))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO listing_meta VALUES (?, ?, ?)', (source, time.time(), count)
+            )
+        return count
+
+    def _where(self, source, pattern):
+        """过滤条件：含 * ? [ 时按通配符匹配，否则按前缀匹配"""
+        if not pattern:
+            return 'source = ?', [source]
+        if any(char in pattern for char in '*?['):
+            return 'source = ? AND key GLOB ?', [source, pattern]
+        return 'source = ? AND key >= ? AND key < ?', [source, pattern, pattern + '\U0010ffff']
+
+    def count(self, source, pattern=''):
+        where, params = self._where(source, pattern)
+        with self.lock:
+            return self.conn.execute(f'SELECT COUNT(*) FROM listing WHERE {where}', params).fetchone()[0]
+
+    def page(self, source, pattern='', after=-1, limit=50):
+        """编号大于after的下一页，返回[(编号, key, 大小)]"""
+        where, params = self._where(source, pattern)
+        with self.lock:
+            return self.conn.execute(
+                f'SELECT seq, key, size FROM listing WHERE {where} AND seq > ? ORDER BY seq LIMIT ?',
+                params + [after, limit]
+            ).fetchall()
+
+    def get(self, source, seq):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT key FROM listing WHERE source = ? AND seq = ?', (source, seq)
+            ).fetchone()
+        return row[0] if row else None
+
+    def sizes(self, source, pattern=''):
+        """{key: 大小}，供批量任务按大小调度"""
+        where, params = self._where(source, pattern)
+        with self.lock:
+            return dict(self.conn.execute(f'SELECT key, size FROM listing WHERE {where}', params))
+
+    def keys(self, source, pattern=''):
+        where, params = self._where(source, pattern)
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                f'SELECT key FROM listing WHERE {where} ORDER BY seq', params
+            )]
+
+_listing_cache = None
+
+def get_listing_cache():
+    """进程内共享的列表缓存，首次使用时打开"""
+    global _listing_cache
+    if _listing_cache is None:
+        _listing_cache = ListingCache(
+            get_setting('listing', 'cache_file', 'listing_cache.db'),
+            get_setting('listing', 'cache_ttl', 3600)
+        )
+    return _listing_cache
+
+def ensure_listing(client, is_ali, refresh=False):
+    """缓存过期或要求刷新时重新列举，返回缓存是否可用（刷新失败时仍可使用旧缓存）"""
+    source = 'aliyun' if is_ali else 'tencent'
+    name = '阿里云OSS' if is_ali else '腾讯云COS'
+    cache = get_listing_cache()
+    try:
+        if refresh or not cache.is_fresh(source):
+            print(f"\n正在获取{name}文件列表...")
+            print(f"找到 {cache.refresh(client, is_ali)} 个文件")
+    except Exception as e:
+        print(f"获取{name}文件列表失败: {str(e)}")
+        return cache.age(source) is not None
+    return True
+
+def browse_source_files(client, is_ali, status_tracker, section='downloaded', selectable=True):
+    """分页浏览缓存的源端文件列表，可按前缀或通配符过滤
+
+    selectable为True时返回(选中的key列表, {key: 大小})（输入序号选择单个，all选择过滤后的全部，
+    大小只在选择全部时提供，仅包含匹配过滤条件的文件），返回(None, None)表示放弃选择。
+    """
+    source = 'aliyun' if is_ali else 'tencent'
+    name = '阿里云OSS' if is_ali else '腾讯云COS'
+    labels = ('已下载', '未下载') if section == 'downloaded' else ('已上传', '未上传')
+    cache = get_listing_cache()
+    page_size = get_setting('listing', 'page_size', 50)
+    if not ensure_listing(client, is_ali):
+        return None, None
+
+    pattern = input("过滤条件 (前缀或通配符如 *.jpg，直接回车显示全部): ").strip()
+    starts = [-1]
+    while True:
+        total = cache.count(source, pattern)
+        rows = cache.page(source, pattern, starts[-1], page_size)
+        age = cache.age(source) or 0
+        print(f"\n{name} 共 {total} 个匹配文件（缓存于 {age/60:.0f} 分钟前），第 {len(starts)} 页：")
+        for seq, key, size in rows:
+            label = labels[0] if key in status_tracker.status[section] else labels[1]
+            print(f"{seq + 1}. {key} ({size/1024:.2f}KB) [{label}]")
+
+        hint = "n 下一页, p 上一页, f 重新过滤, r 刷新列表, q 返回"
+        if selectable:
+            hint = "输入序号选择, all 选择全部匹配文件, " + hint
+        command = input(f"\n{hint}: ").strip().lower()
+        if command == 'n':
+            if len(rows) == page_size:
+                starts.append(rows[-1][0])
+        elif command == 'p':
+            if len(starts) > 1:
+                starts.pop()
+        elif command == 'f':
+            pattern = input("过滤条件: ").strip()
+            starts = [-1]
+        elif command == 'r':
+            try:
+                print(f"找到 {cache.refresh(client, is_ali)} 个文件")
+            except Exception as e:
+                print(f"刷新{name}文件列表失败: {str(e)}")
+            starts = [-1]
+        elif command in ('q', ''):
+            return None, None
+        elif selectable and command == 'all':
+            return cache.keys(source, pattern), cache.sizes(source, pattern)
+        elif selectable:
+            try:
+                key = cache.get(source, int(command) - 1)
+            except ValueError:
+                key = None
+            if key is None:
+                print("无效的输入")
+                continue
+            return [key], None
+        else:
+            print("无效的输入")
+
+def get_file_info(file_path):
+    """获取文件信息（大小和哈希值）"""
+    if not os.path.exists(file_path):
+        return None, None
+    
+    return get_hash_cache().get(file_path)
+
+def stream_to_file(stream, file_path, expected_size=None, expected_md5=None):
+    """把网络流写入文件并同时计算MD5，先写临时文件，校验通过后再改名"""
+    tmp_path = file_path + '.tmp'
+    hash_md5 = hashlib.md5()
+    size = 0
+    with open(tmp_path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(BUFFER_SIZE), b""):
+            f.write(chunk)
+            hash_md5.update(chunk)
+            size += len(chunk)
+    check_downloaded(tmp_path, size, hash_md5.hexdigest(), expected_size, expected_md5)
+    os.replace(tmp_path, file_path)
+    return size, hash_md5.hexdigest()
+
+def check_downloaded(tmp_path, size, file_hash, expected_size, expected_md5):
+    """校验临时文件的大小和MD5，不一致时删除临时文件并抛出异常
+
+    只有校验通过的文件才会出现在下载目录中，"上传全部"和启动时的核对不会把残缺文件当作已下载。
+    """
+    if expected_size is not None and size != expected_size:
+        error = f"下载字节数不匹配: {size} != {expected_size}"
+    elif expected_md5 and file_hash != expected_md5:
+        error = f"下载内容MD5与源端ETag不一致: {file_hash} != {expected_md5}"
+    else:
+        return
+    os.remove(tmp_path)
+    raise IOError(error)
+
+def get_download_path(file_key, source):
+    """获取下载文件的本地保存路径"""
+    # 根据来源创建对应的下载目录
+    base_dir = os.path.join('downloads', source)
+    # 保持原始路径结构
+    full_path = os.path.join(base_dir, file_key)
+    # 确保目录存在
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    return full_path
+
+def download_file(client, file_key, is_ali=True, status_tracker=None, verbose=True, stage='download', size_hint=None):
+    """下载单个文件并记录状态，失败记录的阶段为stage，size_hint为列举得到的对象大小"""
+    try:
+        # 根据来源确定存路径
+        source = 'aliyun' if is_ali else 'tencent'
+        file_path = get_download_path(file_key, source)
+        
+        # 检查是否已经下载
+        if status_tracker and file_key in status_tracker.status['downloaded']:
+            existing_info = status_tracker.status['downloaded'][file_key]
+            if os.path.exists(file_path):
+                size, file_hash = get_file_info(file_path)
+                if file_hash == existing_info['hash']:
+                    if verbose:
+                        print(f"文件已存在且校验通过: {file_key}")
+                    return True, file_path, file_hash, size
+        
+        if verbose:
+            print(f"开始下载: {file_key}")
+        size, file_hash = call_with_retry(fetch_to_file, client, file_key, is_ali, file_path, size_hint)
+        fingerprint = get_hash_cache().put(file_path, file_hash)
+        
+        if status_tracker:
+            status_tracker.mark_downloaded(file_key, file_hash, size, fingerprint)
+        
+        return True, file_path, file_hash, size
+    except Exception as e:
+        if status_tracker:
+            status_tracker.mark_failed(file_key, e, stage)
+        print(f"下载失败: {str(e)}")
+        return False, None, None, None
+
+def fetch_to_file(client, file_key, is_ali, file_path, size_hint=None):
+    """把源端对象下载到file_path，返回(文件大小, MD5)
+
+    size_hint为列举得到的对象大小，小于分段下载阈值时直接GET；大小未知或达到阈值时
+    先HEAD取得大小和ETag，大文件直接分段下载，不再打开一个随即丢弃的完整GET响应。
+    """
+    source = 'aliyun' if is_ali else 'tencent'
+    threshold = get_setting('download', 'multipart_threshold', 64 * 1024 * 1024)
+    content_index = get_content_index()
+    with metrics.timer('download'):
+        head = None
+        if size_hint is None or size_hint >= threshold:
+            head = head_source_object(client, file_key, is_ali)
+        if head and head[0] >= threshold:
+            expected_size, etag, source_md5 = head
+            known_hash = content_index.resolve(etag, expected_size, source_md5) if content_index else None
+            if known_hash and content_index.link_duplicate(known_hash, expected_size, file_path):
+                return expected_size, known_hash
+            # 每个分段单独占用并发槽位
+            size, file_hash = download_ranged(file_key, is_ali, file_path, expected_size, etag, source_md5)
+        else:
+            with get_limiter(source).slot() as slot:
+                stream, expected_size, etag, source_md5 = open_source_stream(client, file_key, is_ali)
+                known_hash = content_index.resolve(etag, expected_size, source_md5) if content_index else None
+                try:
+                    linked = known_hash and content_index.link_duplicate(known_hash, expected_size, file_path)
+                except Exception:
+                    close_stream(stream)
+                    raise
+                if linked:
+                    # 相同内容已下载过，直接链接本地文件
+                    close_stream(stream)
+                    return expected_size, known_hash
+                # 边下载边计算MD5，下载完成后不再重新读取文件
+                size, file_hash = stream_to_file(
+                    ThrottledReader(stream, get_rate_limiter(source)), file_path, expected_size, source_md5
+                )
+                slot['bytes'] = size
+    metrics.add('download', size)
+    if content_index:
+        content_index.add_downloaded(file_hash, file_path, size, etag)
+    return size, file_hash
+
+def close_stream(stream):
+    """关闭尚未读完的源端响应流"""
+    close = getattr(stream, 'close', None)
+    if close:
+        close()
+
+def open_source_range(client, file_key, is_ali, start, end):
+    """打开源端对象[start, end]字节范围的读取流"""
+    if is_ali:
+        return client.get_object(file_key, byte_range=(start, end))
+    response = client.get_object(Bucket=get_required('tencent', 'bucket'), Key=file_key, Range=f'bytes={start}-{end}')
+    return response['Body'].get_raw_stream()
+
+def get_checkpoint_path(file_key, is_ali):
+    """分段下载的断点文件路径，放在单独目录中以免被当作已下载文件"""
+    source = 'aliyun' if is_ali else 'tencent'
+    checkpoint_dir = get_setting('download', 'checkpoint_dir', '.checkpoints')
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    name = hashlib.md5(f'{source}/{file_key}'.encode('utf-8')).hexdigest()
+    return os.path.join(checkpoint_dir, name + '.json')
+
+def download_ranged(file_key, is_ali, file_path, size, etag, expected_md5=None):
+    """多线程按字节范围下载大文件，每完成一段就写断点，进程重启后可从断点继续
+
+    源端对象的大小或ETag变化时断点作废，从头下载；MD5与expected_md5不一致时丢弃整个文件。
+    返回(文件大小, MD5)。
+    """
+    part_size = get_setting('download', 'part_size', 16 * 1024 * 1024)
+    workers = get_setting('download', 'part_workers', 4)
+    tmp_path = file_path + '.tmp'
+    checkpoint_path = get_checkpoint_path(file_key, is_ali)
+
+    done = set()
+    checkpoint = {'key': file_key, 'size': size, 'etag': normalize_etag(etag), 'part_size': part_size}
+    if os.path.exists(checkpoint_path) and os.path.exists(tmp_path):
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        if (all(saved.get(k) == v for k, v in checkpoint.items())
+                and os.path.getsize(tmp_path) == size):
+            done = set(saved['done'])
+    if not done:
+        with open(tmp_path, 'wb') as f:
+            f.truncate(size)
+
+    parts = [
+        (index, start, min(start + part_size, size) - 1)
+        for index, start in enumerate(range(0, size, part_size))
+        if index not in done
+    ]
+    lock = threading.Lock()
+
+    source = 'aliyun' if is_ali else 'tencent'
+
+    def fetch(part):
+        index, start, end = part
+        written = 0
+        with get_limiter(source).slot() as slot:
+            stream = ThrottledReader(
+                open_source_range(get_thread_client(is_ali), file_key, is_ali, start, end),
+                get_rate_limiter(source)
+            )
+            with open(tmp_path, 'r+b') as f:
+                f.seek(start)
+                for chunk in iter(lambda: stream.read(BUFFER_SIZE), b""):
+                    f.write(chunk)
+                    written += len(chunk)
+            slot['bytes'] = written
+        if written != end - start + 1:
+            raise IOError(f"分段 {index} 字节数不匹配: {written} != {end - start + 1}")
+        with lock:
+            done.add(index)
+            write_json_atomic(checkpoint_path, dict(checkpoint, done=sorted(done)))
+
+    for _ in bounded_map(fetch, parts, workers):
+        pass
+
+    # 分段乱序写入，无法边写边算，完成后顺序读一遍计算MD5
+    file_hash = get_file_hash(tmp_path)
+    os.remove(checkpoint_path)
+    check_downloaded(tmp_path, size, file_hash, size, expected_md5)
+    os.replace(tmp_path, file_path)
+    return size, file_hash
+
+def bounded_map(func, items, workers, max_pending=None, name='worker'):
+    """线程池并发执行func，限制在途任务数量，按完成顺序产出(item, result)"""
+    max_pending = max_pending or workers * 4
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name) as executor:
+        pending = {}
+        for item in items:
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[executor.submit(func, item)] = item
+        for future in as_completed(pending):
+            yield pending[future], future.result()
+
+def download_all(files, is_ali, status_tracker, workers=None, sizes=None):
+    """并发下载所有未下载的文件，每个工作线程使用独立的客户端，返回(成功数, 失败数, 总字节数)
+
+    sizes为{key: 大小}（例如列表缓存中的大小），提供时按大小安排下载顺序并显示预计剩余时间。
+    """
+    source = 'aliyun' if is_ali else 'tencent'
+    workers = workers or get_setting('transfer', f'{source}_workers', 8)
+    pending = (f for f in files if f not in status_tracker.status['downloaded'])
+    # 传入列表时先过滤出待下载文件以显示总数；传入生成器时边列举边下载
+    if isinstance(files, list):
+        pending = list(pending)
+        if not pending:
+            print("所有文件均已下载")
+            return 0, 0, 0
+
+    def worker(file_key):
+        success, path, file_hash, size = download_file(
+            get_thread_client(is_ali), file_key, is_ali, status_tracker, verbose=False,
+            size_hint=sizes.get(file_key) if sizes else None
+        )
+        return success, size
+
+    print(f"\n使用 {workers} 个线程下载文件")
+    succeeded, failed, total_bytes = run_with_progress(
+        worker, pending, workers, "下载进度", 'download', sizes.get if sizes else None
+    )
+    status_tracker.save_status()
+    print(f"下载完成: 成功 {succeeded} 个, 失败 {failed} 个, 共 {total_bytes/1024/1024:.2f}MB")
+    return succeeded, failed, total_bytes
+
+def schedule_by_size(items, sizes, workers):
+    """按大小安排执行顺序，缩短整批任务的总耗时
+
+    大对象（单个超过总字节数的1/(4×线程数)）中最大的几个最先启动，其余大对象按字节比例
+    穿插在小对象之间，并保证在小对象过半前全部启动；小对象保持原顺序并在最后收尾，
+    避免某个大对象在末尾单独拖慢整批任务。
+    """
+    total = sum(sizes.values())
+    if len(items) <= workers or not total:
+        return sorted(items, key=lambda item: sizes[item], reverse=True)
+    threshold = total / (workers * 4)
+    large = sorted((item for item in items if sizes[item] > threshold), key=lambda item: sizes[item], reverse=True)
+    small = [item for item in items if sizes[item] <= threshold]
+    if not large or not small:
+        return large + small
+    head_count = max(1, workers // 2)
+    ordered = large[:head_count]
+    rest = large[head_count:]
+    large_total = sum(sizes[item] for item in rest)
+    small_total = sum(sizes[item] for item in small) or 1
+    large_sent = small_sent = 0
+    index = 0
+    for item in small:
+        # 大对象的发送进度保持在小对象的两倍，小对象过半时大对象全部启动
+        while index < len(rest) and large_sent <= 2 * small_sent * large_total / small_total:
+            ordered.append(rest[index])
+            large_sent += sizes[rest[index]]
+            index += 1
+        ordered.append(item)
+        small_sent += sizes[item]
+    ordered.extend(rest[index:])
+    return ordered
+
+def format_duration(seconds):
+    """把秒数格式化为 时:分:秒"""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+def run_with_progress(worker, items, workers, desc, name='worker', size_of=None):
+    """并发执行worker并显示汇总进度条，worker返回(是否成功, 字节数)
+
+    传入列表和size_of时按大小安排执行顺序，并根据已完成部分的吞吐量
+    估算剩余字节数和对象数所需的时间。
+    """
+    start = time.monotonic()
+    total_bytes = 0
+    succeeded = failed = 0
+    total = len(items) if isinstance(items, list) else None
+    sizes = None
+    if total and size_of:
+        sizes = {item: size_of(item) or 0 for item in items}
+        items = schedule_by_size(items, sizes, workers)
+        remaining_bytes = sum(sizes.values())
+    with tqdm(total=total, desc=desc, unit='个') as progress:
+        for item, (success, size) in bounded_map(worker, items, workers, name=name):
+            if success:
+                succeeded += 1
+                total_bytes += size or 0
+            else:
+                failed += 1
+            progress.update(1)
+            elapsed = max(time.monotonic() - start, 1e-6)
+            postfix = f"{total_bytes/1024/1024/elapsed:.2f}MB/s"
+            if sizes:
+                remaining_bytes -= sizes[item]
+                remaining_objects = total - succeeded - failed
+                # 按字节和按对象数的吞吐量分别估算，取较长者
+                byte_rate = (sum(sizes.values()) - remaining_bytes) / elapsed
+                eta = max(
+                    remaining_bytes / byte_rate if byte_rate else 0,
+                    remaining_objects * elapsed / (succeeded + failed)
+                )
+                postfix += f" 剩余 {remaining_objects}个/{remaining_bytes/1024/1024:.1f}MB 预计 {format_duration(eta)}"
+            progress.set_postfix_str(f"{postfix} 并发窗口 {limiter_summary()}")
+    return succeeded, failed, total_bytes
+
+class HashingReader:
+    """包装源端响应流，数据流过时同步计算MD5和字节数
+
+    指定part_size时同时按分片计算MD5，用于推算MinIO分片上传后的ETag。
+    """
+    def __init__(self, stream, part_size=None):
+        self.stream = stream
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.part_size = part_size
+        self.part_md5 = hashlib.md5()
+        self.part_filled = 0
+        self.part_digests = []
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.md5.update(data)
+        self.size += len(data)
+        if self.part_size:
+            view = memoryview(data)
+            while view:
+                chunk = view[:self.part_size - self.part_filled]
+                self.part_md5.update(chunk)
+                self.part_filled += len(chunk)
+                view = view[len(chunk):]
+                if self.part_filled == self.part_size:
+                    self.part_digests.append(self.part_md5.digest())
+                    self.part_md5 = hashlib.md5()
+                    self.part_filled = 0
+        return data
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+    def multipart_etag(self):
+        """按S3规则推算分片上传的ETag，只有一个分片时就是内容MD5"""
+        digests = list(self.part_digests)
+        if self.part_filled:
+            digests.append(self.part_md5.digest())
+        if len(digests) <= 1:
+            return self.hexdigest()
+        return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+def open_source_stream(client, file_key, is_ali=True):
+    """打开源端对象的读取流，返回(流, 对象大小, 源端ETag, 可信的内容MD5或None)"""
+    if is_ali:
+        result = client.get_object(file_key)
+        headers = getattr(result, 'headers', None)
+        return result, result.content_length, result.etag, source_content_md5(result.etag, headers)
+    response = client.get_object(Bucket=get_required('tencent', 'bucket'), Key=file_key)
+    etag = response.get('ETag')
+    return response['Body'].get_raw_stream(), int(response['Content-Length']), etag, source_content_md5(etag, response)
+
+def head_source_object(client, file_key, is_ali=True):
+    """只读取源端对象的元数据，返回(对象大小, 源端ETag, 可信的内容MD5或None)"""
+    if is_ali:
+        result = client.head_object(file_key)
+        headers = getattr(result, 'headers', None)
+        return result.content_length, result.etag, source_content_md5(result.etag, headers)
+    response = client.head_object(Bucket=get_required('tencent', 'bucket'), Key=file_key)
+    etag = response.get('ETag')
+    return int(response['Content-Length']), etag, source_content_md5(etag, response)
+
+def source_content_md5(etag, headers):
+    """源端ETag确实是内容MD5时返回它，否则返回None
+
+    分片上传、追加上传(appendable)以及KMS/SSE-C加密的对象，ETag都不是内容MD5，
+    不能用来校验数据或写入MD5元数据。
+    """
+    etag = normalize_etag(etag)
+    if len(etag) != 32 or any(c not in '0123456789abcdef' for c in etag):
+        return None
+    for prefix in ('x-oss-', 'x-cos-'):
+        if get_metadata_value(headers, prefix + 'object-type') == 'appendable':
+            return None
+        if get_metadata_value(headers, prefix + 'server-side-encryption') not in (None, 'aes256'):
+            return None
+        if get_metadata_value(headers, prefix + 'server-side-encryption-customer-algorithm'):
+            return None
+    return etag
+
+def transfer_file(client, minio_client, file_key, is_ali=True, status_tracker=None, verbose=True):
+    """把源端对象流式写入MinIO，不在本地落盘，返回(是否成功, 文件hash, 文件大小)"""
+    try:
+        if verbose:
+            print(f"开始迁移: {file_key}")
+        file_hash, size, etag = call_with_retry(stream_to_minio, client, minio_client, file_key, is_ali)
+        if status_tracker:
+            status_tracker.mark_uploaded(file_key, file_hash, size, etag)
+        return True, file_hash, size
+    except Exception as e:
+        if status_tracker:
+            status_tracker.mark_failed(file_key, e, 'transfer')
+        print(f"迁移失败: {file_key} - {str(e)}")
+        return False, None, None
+
+def stream_to_minio(client, minio_client, file_key, is_ali):
+    """把源端对象的数据流写入MinIO并校验ETag，返回(MD5, 大小, MinIO ETag)"""
+    source = 'aliyun' if is_ali else 'tencent'
+    with metrics.timer('transfer'), get_limiter(source).slot() as source_slot, \
+            get_limiter('minio').slot() as minio_slot:
+        stream, size, source_etag, source_md5 = open_source_stream(client, file_key, is_ali)
+        content_index = get_content_index()
+        known_hash = content_index.resolve(source_etag, size, source_md5) if content_index else None
+        try:
+            etag = content_index.copy_duplicate(minio_client, known_hash, size, file_key) if known_hash else None
+        except Exception:
+            close_stream(stream)
+            raise
+        if etag is not None:
+            # MinIO中已有相同内容，服务端复制后不再读取源端数据
+            close_stream(stream)
+            return known_hash, size, etag
+        # 每个传输最多在内存中缓冲一个分片：分片逐个上传(num_parallel_uploads=1)，
+        # minio-py默认的3路并行上传会同时缓冲约4个分片
+        part_size = get_setting('transfer', 'direct_part_size', 16 * 1024 * 1024)
+        reader = HashingReader(
+            ThrottledReader(stream, get_rate_limiter(source), get_rate_limiter('minio')), part_size
+        )
+        # 源端ETag可信地等于内容MD5时提前写入元数据，分片上传的对象也能按MD5校验
+        metadata = {MD5_METADATA_KEY: source_md5} if source_md5 else {}
+        result = minio_client.put_object(
+            get_required('minio', 'bucket'), file_key, reader, size, part_size=part_size, metadata=metadata or None,
+            num_parallel_uploads=1
+        )
+        source_slot['bytes'] = minio_slot['bytes'] = reader.size
+    metrics.add('transfer', reader.size)
+    if reader.size != size:
+        raise IOError(f"读取字节数不匹配: {reader.size} != {size}")
+    file_hash = reader.hexdigest()
+    # put_object返回的ETag直接和数据流推算的ETag比对，不需要额外请求
+    matched = match_checksums(
+        [result.etag], [file_hash, reader.multipart_etag()]
+    )
+    if matched is False:
+        raise IOError(f"ETag不匹配: MinIO {normalize_etag(result.etag)}, 预期 {reader.multipart_etag()}")
+    if source_md5 and source_md5 != file_hash:
+        raise IOError(f"内容MD5与源端ETag不一致: {file_hash} != {source_md5}")
+    if content_index:
+        content_index.add_uploaded(file_hash, file_key, size, source_etag)
+    return file_hash, size, result.etag
+
+def transfer_all(files, is_ali, status_tracker, minio_client, workers=None, skip_uploaded=True, sizes=None):
+    """并发直接迁移文件，返回(成功数, 失败数, 总字节数)
+
+    skip_uploaded为False时即使状态中已上传也重新迁移（增量同步中源端已变化的文件）。
+    sizes为{key: 大小}，提供时按大小安排迁移顺序并显示预计剩余时间。
+    """
+    source = 'aliyun' if is_ali else 'tencent'
+    workers = workers or get_setting('transfer', f'{source}_workers', 8)
+    pending = (f for f in files if not skip_uploaded or f not in status_tracker.status['uploaded'])
+    if isinstance(files, list):
+        pending = list(pending)
+        if not pending:
+            print("所有文件均已上传")
+            return 0, 0, 0
+    batched = (0, 0, 0)
+    if sizes and isinstance(pending, list):
+        # 已知大小的小对象打包上传
+        small, pending = split_small(pending, lambda file_key: sizes.get(file_key, float('inf')))
+        if small:
+            batched = run_batches(
+                minio_client, small, lambda file_key: file_key, sizes.get,
+                lambda file_key: call_with_retry(read_source_object, get_thread_client(is_ali), file_key, is_ali),
+                lambda file_key: status_tracker, 'transfer', workers
+            )
+            if not pending:
+                status_tracker.save_status()
+                return batched
+
+    def worker(file_key):
+        success, file_hash, size = transfer_file(
+            get_thread_client(is_ali), minio_client, file_key, is_ali, status_tracker, verbose=False
+        )
+        return success, size
+
+    print(f"\n使用 {workers} 个线程直接迁移文件")
+    succeeded, failed, total_bytes = run_with_progress(
+        worker, pending, workers, "迁移进度", 'transfer', sizes.get if sizes else None
+    )
+    status_tracker.save_status()
+    print(f"迁移完成: 成功 {succeeded} 个, 失败 {failed} 个, 共 {total_bytes/1024/1024:.2f}MB")
+    return succeeded + batched[0], failed + batched[1], total_bytes + batched[2]
+
+# 上传时把内容MD5写入用户元数据，分片上传的对象也能按MD5校验
+MD5_METADATA_KEY = 'x-amz-meta-md5'
+
+def normalize_etag(etag):
+    """去掉ETag两端的引号并统一为小写"""
+    return (etag or '').strip().strip('"').lower()
+
+def is_multipart_etag(etag):
+    """分片上传的ETag形如 <hash>-<分片数>，不是内容MD5"""
+    return '-' in normalize_etag(etag)
+
+def etag_part_count(etag):
+    """返回ETag对应的分片数，普通上传返回0"""
+    etag = normalize_etag(etag)
+    if '-' not in etag:
+        return 0
+    try:
+        return int(etag.rsplit('-', 1)[1])
+    except ValueError:
+        return -1
+
+def get_metadata_value(metadata, key):
+    """大小写无关地读取stat_object返回的元数据"""
+    for name, value in (metadata or {}).items():
+        if name.lower() == key:
+            return normalize_etag(value)
+    return None
+
+def match_checksums(actual, expected):
+    """比较两组校验和：任一相同返回True，存在可比较的值但都不同返回False，无法比较返回None
+
+    只有分片数相同的ETag才可比较，普通ETag即内容MD5。两组值必须来源独立，
+    例如MinIO的ETag和由数据计算的MD5，不能拿我们自己写入的值互相印证。
+    """
+    actual = [normalize_etag(a) for a in actual if a]
+    expected = [normalize_etag(e) for e in expected if e]
+    comparable = False
+    for e in expected:
+        for a in actual:
+            if e == a:
+                return True
+            if etag_part_count(e) == etag_part_count(a) >= 0:
+                comparable = True
+    return False if comparable else None
+
+def verify_minio_upload(minio_client, remote_path, expected_md5=None, expected_size=None,
+                        expected_etag=None):
+    """通过stat_object比对大小和ETag验证MinIO上传，不读取本地文件
+
+    expected_md5和expected_etag必须由数据本身计算（内容MD5、按上传分片大小推算的分片ETag），
+    不能传入MinIO返回的ETag。MinIO的ETag可比较（分片数相同）时必须一致；
+    不可比较时（例如分片大小未知的分片对象）才用元数据中记录的MD5，都没有时只校验大小。
+    """
+    try:
+        # 获取MinIO中文件的信息
+        with metrics.timer('verify'):
+            stat = minio_client.stat_object(get_required('minio', 'bucket'), remote_path)
+        metrics.add('verify')
+        # 比较大小
+        if expected_size is not None and stat.size != expected_size:
+            metrics.record_error('verify', 'mismatch')
+            return False, "文件大小不匹配"
+        matched = match_checksums([stat.etag], [expected_md5, expected_etag])
+        if matched is None:
+            matched = match_checksums([get_metadata_value(stat.metadata, MD5_METADATA_KEY)], [expected_md5])
+        if matched is False:
+            metrics.record_error('verify', 'mismatch')
+            return False, f"校验和不匹配: MinIO ETag {normalize_etag(stat.etag)}"
+        return True, None
+    except Exception as e:
+        return False, str(e)
+
+def upload_staged_file(minio_client, relative_path, full_path, status_tracker, stage='upload'):
+    """上传已下载到本地的文件并校验，失败记录的阶段为stage，返回(是否成功, 错误信息)"""
+    try:
+        # 优先使用下载时记录的hash，避免再读一遍文件
+        size = os.path.getsize(full_path)
+        record = status_tracker.status['downloaded'].get(relative_path)
+        if record and record.get('size') == size and record.get('hash'):
+            file_hash = record['hash']
+        else:
+            size, file_hash = get_file_info(full_path)
+        content_index = get_content_index()
+        etag = content_index.copy_duplicate(minio_client, file_hash, size, relative_path) if content_index else None
+        if etag is None:
+            etag = call_with_retry(put_staged_file, minio_client, relative_path, full_path, file_hash, size)
+            if content_index:
+                content_index.add_uploaded(file_hash, relative_path, size)
+        status_tracker.mark_uploaded(relative_path, file_hash, size, etag)
+        return True, None
+    except Exception as e:
+        status_tracker.mark_failed(relative_path, e, stage)
+        return False, str(e)
+
+def put_staged_file(minio_client, relative_path, full_path, file_hash, size):
+    """上传本地文件并校验，校验失败时抛出异常，返回MinIO ETag
+
+    上传时边读边计算MD5和按分片大小推算的ETag：MD5与下载时记录的不同说明本地文件已损坏，
+    MinIO的ETag与推算值不同说明传输中损坏。
+    """
+    part_size, parallel_parts, _ = get_upload_settings()
+    with metrics.timer('upload'), get_limiter('minio').slot() as slot:
+        # 自己读取文件（而不是fput_object），才能计算实际上传的数据的校验和，限速时也按令牌桶控制速度
+        with open(full_path, 'rb') as f:
+            reader = HashingReader(ThrottledReader(f, get_rate_limiter('minio')), part_size)
+            result = minio_client.put_object(
+                get_required('minio', 'bucket'), relative_path, reader, size,
+                metadata={MD5_METADATA_KEY: file_hash},
+                part_size=part_size, num_parallel_uploads=parallel_parts
+            )
+        slot['bytes'] = size
+    metrics.add('upload', size)
+    if reader.size != size or reader.hexdigest() != file_hash:
+        raise IOError(f"本地文件已变化: MD5 {reader.hexdigest()}, 下载时 {file_hash}")
+    expected_etag = reader.multipart_etag()
+    if match_checksums([result.etag], [expected_etag]) is False:
+        raise IOError(f"ETag不匹配: MinIO {normalize_etag(result.etag)}, 预期 {expected_etag}")
+    success, error = verify_minio_upload(
+        minio_client, relative_path, file_hash, size, expected_etag
+    )
+    if not success:
+        raise IOError(f"上传验证失败: {error}")
+    return result.etag
+
+def percentile(values, fraction):
+    """返回已排序列表中指定分位的值"""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class TransferStats:
+    """记录每个文件的耗时和吞吐，传输结束后输出统计"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []  # [(file_key, size, seconds)]
+        self.start = time.monotonic()
+
+    def add(self, file_key, size, seconds):
+        with self.lock:
+            self.records.append((file_key, size, seconds))
+
+    def summary(self, slowest=5):
+        if not self.records:
+            return
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        total_bytes = sum(size for _, size, _ in self.records)
+        latencies = sorted(seconds for _, _, seconds in self.records)
+        print("\n=== 传输统计 ===")
+        print(f"文件数: {len(self.records)}, 总大小: {total_bytes/1024/1024:.2f}MB, "
+              f"总吞吐: {total_bytes/1024/1024/elapsed:.2f}MB/s, {len(self.records)/elapsed:.1f}个/s")
+        print(f"单文件耗时: P50 {percentile(latencies, 0.5):.3f}s, "
+              f"P95 {percentile(latencies, 0.95):.3f}s, 最大 {latencies[-1]:.3f}s")
+        print(f"最慢的 {min(slowest, len(self.records))} 个文件:")
+        for file_key, size, seconds in sorted(self.records, key=lambda r: r[2], reverse=True)[:slowest]:
+            print(f"- {file_key} ({size/1024:.2f}KB) {seconds:.3f}s, "
+                  f"{size/1024/1024/max(seconds, 1e-6):.2f}MB/s")
+
+def upload_all(all_files, ali_status, tx_status, minio_client, workers=None):
+    """并发上传已下载的文件，all_files为[(来源, 相对路径, 完整路径)]，返回(成功数, 失败数, 总字节数)
+
+    只上传一个来源时另一个来源的状态可以传None。
+    """
+    workers = workers or get_upload_settings()[2]
+    trackers = {'aliyun': ali_status, 'tencent': tx_status}
+    pending = [
+        item for item in all_files
+        if item[1] not in trackers[item[0]].status['uploaded']
+    ]
+    if not pending:
+        print("所有文件均已上传")
+        return 0, 0, 0
+    batched = (0, 0, 0)
+    small, pending = split_small(pending, lambda item: os.path.getsize(item[2]))
+    if small:
+        batched = run_batches(
+            minio_client, small, lambda item: item[1], lambda item: os.path.getsize(item[2]),
+            lambda item: read_staged_file(item[2], trackers[item[0]].status['downloaded'].get(item[1])),
+            lambda item: trackers[item[0]], 'upload', workers
+        )
+    succeeded = failed = total_bytes = 0
+    if pending:
+        stats = TransferStats()
+
+        def worker(item):
+            source, relative_path, full_path = item
+            start = time.monotonic()
+            success, error = upload_staged_file(
+                minio_client, relative_path, full_path, trackers[source]
+            )
+            if success:
+                size = os.path.getsize(full_path)
+                stats.add(relative_path, size, time.monotonic() - start)
+                return True, size
+            tqdm.write(f"上传失败: [{source}] {relative_path} - {error}")
+            return False, 0
+
+        print(f"\n使用 {workers} 个线程上传 {len(pending)} 个文件")
+        succeeded, failed, total_bytes = run_with_progress(
+            worker, pending, workers, "上传进度", 'upload', lambda item: os.path.getsize(item[2])
+        )
+        print(f"上传完成: 成功 {succeeded} 个, 失败 {failed} 个, 共 {total_bytes/1024/1024:.2f}MB")
+        stats.summary()
+    for tracker in trackers.values():
+        if tracker:
+            tracker.save_status()
+    return succeeded + batched[0], failed + batched[1], total_bytes + batched[2]
+
+def list_staged_files(source):
+    """已下载到本地、可以上传的文件 [(来源, 相对路径, 完整路径)]"""
+    base_dir = os.path.join('downloads', source)
+    return [
+        (source, os.path.relpath(full_path, base_dir), full_path)
+        for full_path, _ in iter_local_files(base_dir)
+    ]
+
+# MinIO收到带此元数据的tar后自动解包，每个成员成为独立对象；只有单次PutObject才会解包，分片上传不会
+SNOWBALL_METADATA = {'X-Amz-Meta-Snowball-Auto-Extract': 'true'}
+# minio-py的最小分段大小(5MiB)和单次PutObject的大小上限(5GiB)
+MIN_PART_SIZE = 5 * 1024 * 1024
+SINGLE_PUT_LIMIT = 5 * 1024 * 1024 * 1024
+
+def get_batch_settings():
+    """返回(是否开启打包上传, 单个对象大小上限, 单个tar包大小上限, 单个tar包对象数上限)"""
+    return (
+        get_setting('batch', 'enabled', False),
+        get_setting('batch', 'max_object_size', 128 * 1024),
+        min(get_setting('batch', 'max_batch_size', 64 * 1024 * 1024), SINGLE_PUT_LIMIT // 2),
+        get_setting('batch', 'max_batch_objects', 10000)
+    )
+
+def split_small(items, size_of):
+    """按配置分出可以打包上传的小对象，返回(小对象列表, 其余对象列表)；未开启打包时全部归为其余"""
+    enabled, max_object_size, _, _ = get_batch_settings()
+    if not enabled:
+        return [], list(items)
+    small, rest = [], []
+    for item in items:
+        (small if size_of(item) <= max_object_size else rest).append(item)
+    return small, rest
+
+def make_batches(items, key_of, size_of):
+    """按key排序后切分为不超过大小和数量上限的批次，同一批的对象在MinIO中彼此相邻"""
+    _, _, max_batch_size, max_batch_objects = get_batch_settings()
+    batch, batch_bytes = [], 0
+    for item in sorted(items, key=key_of):
+        if batch and (batch_bytes + size_of(item) > max_batch_size or len(batch) >= max_batch_objects):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(item)
+        batch_bytes += size_of(item)
+    if batch:
+        yield batch
+
+def pack_and_upload(minio_client, batch, key_of, load):
+    """把一批小对象在内存中打包为tar上传，返回({key: (MD5, 大小)}, {key: 读取失败的错误})"""
+    buffer = io.BytesIO()
+    checksums = {}
+    errors = {}
+    with tarfile.open(fileobj=buffer, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        for item in batch:
+            file_key = key_of(item)
+            try:
+                data = load(item)
+            except Exception as e:
+                errors[file_key] = e
+                continue
+            info = tarfile.TarInfo(file_key)
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(data))
+            checksums[file_key] = (hashlib.md5(data).hexdigest(), len(data))
+    if not checksums:
+        return checksums, errors
+    size = buffer.tell()
+    if size > SINGLE_PUT_LIMIT:
+        raise ValueError(f"tar包 {size} 字节超过单次上传上限，请调小 batch.max_batch_size")
+    tar_name = f"snowball/{time.time_ns()}-{threading.get_ident()}.tar"
+    with metrics.timer('batch'), get_limiter('minio').slot() as slot:
+        call_with_retry(put_tar, minio_client, tar_name, buffer, size)
+        slot['bytes'] = size
+    check_extracted(minio_client, tar_name)
+    metrics.add('batch', size, objects=len(checksums))
+    return checksums, errors
+
+def put_tar(minio_client, tar_name, buffer, size):
+    """以单次PutObject上传内存中的tar包（分段大小不小于整个包），重试时从头读取"""
+    buffer.seek(0)
+    minio_client.put_object(
+        get_required('minio', 'bucket'), tar_name,
+        ThrottledReader(buffer, get_rate_limiter('minio')), size,
+        content_type='application/x-tar', metadata=SNOWBALL_METADATA,
+        part_size=max(size, MIN_PART_SIZE)
+    )
+
+def check_extracted(minio_client, tar_name):
+    """解包成功时tar包本身不会保存；若仍存在说明MinIO未解包，删除后整批按失败处理"""
+    try:
+        minio_client.stat_object(get_required('minio', 'bucket'), tar_name)
+    except Exception as e:
+        if get_error_code(e) == 'NoSuchKey':
+            return
+        raise
+    minio_client.remove_object(get_required('minio', 'bucket'), tar_name)
+    raise IOError(f"MinIO未自动解包 {tar_name}，请确认服务端支持snowball解包")
+
+def verify_batched(minio_client, uploaded):
+    """列举一个批次的key范围核对解包后的对象，uploaded为{key: (MD5, 大小)}，产出(key, ETag, 错误信息)
+
+    同一批的key相邻，只列举从第一个key到最后一个key之间的对象。
+    """
+    keys = sorted(uploaded)
+    remaining = dict(uploaded)
+    prefix = os.path.commonprefix([keys[0], keys[-1]])
+    for minio_obj in iter_minio_objects(minio_client, prefix, start_after=keys[0][:-1]):
+        if minio_obj['key'] > keys[-1]:
+            break
+        entry = remaining.pop(minio_obj['key'], None)
+        if entry is None:
+            continue
+        file_hash, size = entry
+        matched, reason = check_listed_object({'hash': file_hash, 'size': size}, minio_obj)
+        if matched is None:
+            matched, reason = verify_minio_upload(minio_client, minio_obj['key'], file_hash, size)
+        yield minio_obj['key'], minio_obj['etag'], None if matched else reason
+    for file_key in remaining:
+        yield file_key, None, "解包后MinIO中不存在"
+
+def run_batches(minio_client, items, key_of, size_of, load, tracker_of, stage, workers):
+    """打包上传小对象并逐个记录状态，每个tar包上传后立即核对该批次，返回(成功数, 失败数, 总字节数)
+
+    load读取对象内容，内容与下载记录或源端MD5不一致时应抛出异常，该对象不会被打包。
+    """
+    counts = {'succeeded': 0, 'failed': 0, 'bytes': 0}
+    lock = threading.Lock()
+    content_index = get_content_index()
+
+    def worker(batch):
+        items_by_key = {key_of(item): item for item in batch}
+        try:
+            checksums, errors = pack_and_upload(minio_client, batch, key_of, load)
+            verified = list(verify_batched(minio_client, checksums)) if checksums else []
+        except Exception as e:
+            checksums, errors, verified = {}, {key_of(item): e for item in batch}, []
+        for file_key, etag, error in verified:
+            if error:
+                errors[file_key] = error
+                continue
+            file_hash, size = checksums[file_key]
+            tracker_of(items_by_key[file_key]).mark_uploaded(file_key, file_hash, size, etag)
+            if content_index:
+                content_index.add_uploaded(file_hash, file_key, size)
+        for file_key, error in errors.items():
+            tracker_of(items_by_key[file_key]).mark_failed(file_key, error, stage)
+        batch_bytes = sum(size for file_key, (_, size) in checksums.items() if file_key not in errors)
+        with lock:
+            counts['succeeded'] += len(batch) - len(errors)
+            counts['failed'] += len(errors)
+            counts['bytes'] += batch_bytes
+        return not errors, batch_bytes
+
+    batches = list(make_batches(items, key_of, size_of))
+    print(f"\n{len(items)} 个小对象打包为 {len(batches)} 个tar上传")
+    run_with_progress(worker, batches, workers, "打包上传", 'batch')
+    succeeded, failed, total_bytes = counts['succeeded'], counts['failed'], counts['bytes']
+    print(f"打包上传完成: 成功 {succeeded} 个, 失败 {failed} 个, 共 {total_bytes/1024/1024:.2f}MB")
+    return succeeded, failed, total_bytes
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def read_staged_file(full_path, record):
+    """完整读取一个已下载的小文件，与下载记录的MD5不一致时抛出异常（同put_staged_file）"""
+    data = read_file(full_path)
+    if record and record.get('size') == len(data) and record.get('hash'):
+        file_hash = hashlib.md5(data).hexdigest()
+        if file_hash != record['hash']:
+            raise IOError(f"本地文件已变化: MD5 {file_hash}, 下载时 {record['hash']}")
+    return data
+
+def read_source_object(client, file_key, is_ali):
+    """完整读取一个源端小对象，源端ETag是可信的内容MD5时核对（同stream_to_minio）"""
+    stream, size, _, source_md5 = open_source_stream(client, file_key, is_ali)
+    try:
+        data = stream.read()
+    finally:
+        close_stream(stream)
+    if len(data) != size:
+        raise IOError(f"读取字节数不匹配: {len(data)} != {size}")
+    if source_md5 and hashlib.md5(data).hexdigest() != source_md5:
+        raise IOError(f"内容MD5与源端ETag不一致: {hashlib.md5(data).hexdigest()} != {source_md5}")
+    return data
+
+def iter_minio_objects(minio_client, prefix='', start_after=None):
+    """流式列举MinIO对象，产出与源端列表相同结构的元数据（按key排序），start_after不为空时从该key之后开始"""
+    for obj in minio_client.list_objects(
+            get_required('minio', 'bucket'), prefix=prefix, recursive=True, start_after=start_after or None):
+        if obj.is_dir:
+            continue
+        yield make_object_info(obj.object_name, obj.size, obj.etag, obj.last_modified)
+
+def object_changed(source_obj, minio_obj, record=None, etag_hashes=None):
+    """判断源端对象相对MinIO中的副本是否已变化
+
+    源端ETag不一定是内容MD5（分片大小不同、KMS加密等），两边ETag不同并不说明内容不同。
+    只有两边的内容MD5都能确定时才比较MD5：源端MD5来自上传记录（ETag等于记录的MD5）
+    或去重索引中的ETag→MD5表(etag_hashes)，MinIO的MD5来自上传记录或普通ETag。
+    无法确定时，源端修改时间晚于MinIO副本说明上传后又被修改过。
+    """
+    if source_obj['size'] != minio_obj['size']:
+        return True
+    if source_obj['etag'] == minio_obj['etag']:
+        return False
+    record = record or {}
+    source_hash = None
+    if source_obj['etag'] == record.get('hash'):
+        source_hash = record['hash']
+    elif etag_hashes:
+        source_hash = etag_hashes.get(f"{source_obj['etag']}:{source_obj['size']}")
+    minio_hash = None
+    if record.get('etag') and normalize_etag(record['etag']) == minio_obj['etag']:
+        minio_hash = record.get('hash')
+    elif not is_multipart_etag(minio_obj['etag']):
+        minio_hash = minio_obj['etag']
+    if source_hash and minio_hash:
+        return source_hash != minio_hash
+    return source_obj['last_modified'] > minio_obj['last_modified']
+
+def diff_listings(source_objects, minio_objects, records=None, etag_hashes=None):
+    """按key有序归并两个列表，产出('new'|'changed'|'deleted', 对象元数据)
+
+    两个列表都必须按key升序排列（OSS/COS/MinIO列举的默认顺序）。
+    records为该来源的上传记录，etag_hashes为去重索引的ETag→MD5表，用于判断对象是否变化。
+    """
+    source_iter = iter(source_objects)
+    minio_iter = iter(minio_objects)
+    src = next(source_iter, None)
+    dst = next(minio_iter, None)
+    while src is not None or dst is not None:
+        if dst is None or (src is not None and src['key'] < dst['key']):
+            yield 'new', src
+            src = next(source_iter, None)
+        elif src is None or dst['key'] < src['key']:
+            yield 'deleted', dst
+            dst = next(minio_iter, None)
+        else:
+            if object_changed(src, dst, (records or {}).get(src['key']), etag_hashes):
+                yield 'changed', src
+            src = next(source_iter, None)
+            dst = next(minio_iter, None)
+
+def sync_source(client, is_ali, status_tracker, minio_client, delete=False):
+    """增量同步：对比源端与MinIO列表，只迁移新增和变化的对象
+
+    MinIO中多出的对象只有在状态记录中由该来源上传过时才算作源端已删除，
+    delete为True时从MinIO删除这些对象。返回各类差异的数量。
+    """
+    counts = {'new': 0, 'changed': 0, 'deleted': 0}
+    deleted_keys = []
+
+    def delta_keys():
+        # 同步需要有序列表，不能使用按前缀并发的列举
+        source_objects = iter_source_objects(client, is_ali, parallel=False)
+        content_index = get_content_index()
+        etag_hashes = content_index.store.status['etags'] if content_index else None
+        for kind, obj in diff_listings(
+                source_objects, iter_minio_objects(minio_client), status_tracker.status['uploaded'], etag_hashes):
+            if kind == 'deleted':
+                if obj['key'] in status_tracker.status['uploaded']:
+                    counts['deleted'] += 1
+                    deleted_keys.append(obj['key'])
+                continue
+            counts[kind] += 1
+            yield obj['key']
+
+    transfer_all(delta_keys(), is_ali, status_tracker, minio_client, skip_uploaded=False)
+    print(f"差异统计: 新增 {counts['new']} 个, 变化 {counts['changed']} 个, 源端已删除 {counts['deleted']} 个")
+
+    if delete and deleted_keys:
+        from minio.deleteobjects import DeleteObject
+        errors = minio_client.remove_objects(
+            get_required('minio', 'bucket'), (DeleteObject(key) for key in deleted_keys)
+        )
+        failed_keys = set()
+        for error in errors:
+            failed_keys.add(error.name)
+            print(f"删除失败: {error.name} - {error.message}")
+        for key in deleted_keys:
+            if key not in failed_keys:
+                status_tracker.record('uploaded', key, None)
+        status_tracker.save_status()
+        print(f"已从MinIO删除 {len(deleted_keys) - len(failed_keys)} 个对象")
+    return counts
+
+def check_listed_object(info, minio_obj):
+    """用列表中的大小和ETag核对一条上传记录，返回(结果, 原因)
+
+    结果为True/False；ETag是分片ETag且没有记录上传时的ETag、无法直接比较时返回None，
+    需要再用stat_object读取元数据中的MD5确认。
+    """
+    if info.get('size') is not None and minio_obj['size'] != info['size']:
+        return False, f"大小不一致: MinIO {minio_obj['size']}, 记录 {info['size']}"
+    matched = match_checksums([minio_obj['etag']], [info.get('hash'), info.get('etag')])
+    if matched is False:
+        return False, f"校验和不匹配: MinIO ETag {normalize_etag(minio_obj['etag'])}"
+    return matched, None
+
+def verify_all(minio_client, trackers, workers=None, report_path=None):
+    """批量核对上传记录与MinIO中的对象
+
+    只列举一遍MinIO，按key与各来源的上传记录对照，用大小和ETag直接判断；
+    只有分片ETag无法比较的对象才并发调用stat_object。不一致或缺失的对象
+    会从上传记录中移除并记为transfer阶段的失败，之后可用"重试失败的文件"重新迁移。
+    trackers为{来源: FileStatus}，返回(通过数, 问题列表)。
+    """
+    workers = workers or get_upload_settings()[2]
+    report_path = report_path or get_setting('verify', 'report_file', 'verify_report.json')
+    expected = {}
+    for source, tracker in trackers.items():
+        with tracker.lock:
+            uploaded = list(tracker.status['uploaded'].items())
+        for file_key, info in uploaded:
+            expected[file_key] = (source, info)
+    if not expected:
+        print("没有上传记录")
+        return 0, []
+
+    verified = 0
+    problems = []
+    ambiguous = []
+    with tqdm(total=len(expected), desc="核对列表", unit='个') as progress:
+        for minio_obj in iter_minio_objects(minio_client):
+            entry = expected.pop(minio_obj['key'], None)
+            if entry is None:
+                continue
+            source, info = entry
+            matched, reason = check_listed_object(info, minio_obj)
+            if matched is None:
+                ambiguous.append((minio_obj['key'], source, info))
+            elif matched:
+                verified += 1
+            else:
+                problems.append({'key': minio_obj['key'], 'source': source, 'reason': reason})
+            progress.update(1)
+    for file_key, (source, info) in expected.items():
+        problems.append({'key': file_key, 'source': source, 'reason': 'MinIO中不存在'})
+
+    if ambiguous:
+        def worker(item):
+            file_key, source, info = item
+            return verify_minio_upload(minio_client, file_key, info.get('hash'), info.get('size'))
+
+        print(f"\n{len(ambiguous)} 个分片对象无法通过ETag判断，读取元数据确认")
+        for (file_key, source, info), (success, error) in tqdm(
+                bounded_map(worker, ambiguous, workers, name='verify'),
+                total=len(ambiguous), desc="确认元数据", unit='个'):
+            if success:
+                verified += 1
+            else:
+                problems.append({'key': file_key, 'source': source, 'reason': error})
+
+    for problem in problems:
+        tracker = trackers[problem['source']]
+        tracker.record('uploaded', problem['key'], None)
+        tracker.mark_failed(problem['key'], problem['reason'], stage='transfer')
+    for tracker in trackers.values():
+        tracker.save_status()
+
+    write_json_atomic(report_path, {
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'verified': verified,
+        'stat_fallback': len(ambiguous),
+        'problems': problems
+    }, indent=2)
+    print(f"\n验证完成: 通过 {verified} 个, 有问题 {len(problems)} 个 (其中 {len(ambiguous)} 个通过元数据确认)")
+    if problems:
+        for problem in problems[:20]:
+            print(f"- [{problem['source']}] {problem['key']}: {problem['reason']}")
+        if len(problems) > 20:
+            print(f"... 共 {len(problems)} 个")
+        print(f"完整报告已写入 {report_path}，这些对象已加入失败记录，可用\"重试失败的文件\"重新迁移")
+    return verified, problems
 
-class FileStatus:
-    def __init__(self, source_path):
-        self.status_file = source_path + '_status.json'
-        self.load_status()
+class StagingBudget:
+    """限制已下载但尚未上传完成的本地字节数，超过水位时阻塞新的下载"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
 
-    def load_status(self):
-        if os.path.exists(self.status_file):
-            with open(self.status_file, 'r', encoding='utf-8') as f:
-                self.status = json.load(f)
-        else:
-            self.status = {
-                'downloaded': {},  # {file_key: {'hash': 'xxx', 'size': 123, 'time': 'xxx'}}
-                'uploaded': {},    # {file_key: {'hash': 'xxx', 'time': 'xxx'}}
-                'failed': {}       # {file_key: {'error': 'xxx', 'time': 'xxx'}}
-            }
+    def acquire(self, size, stop=None):
+        """占用size字节；没有已占用字节时总是放行，避免单个超大文件永远等待"""
+        with self.cond:
+            while self.used > 0 and self.used + size > self.limit:
+                if stop is not None and stop.is_set():
+                    return False
+                self.cond.wait(timeout=0.5)
+            self.used += size
+            return True
 
-    def save_status(self):
-        with open(self.status_file, 'w', encoding='utf-8') as f:
-            json.dump(self.status, f, ensure_ascii=False, indent=2)
+    def release(self, size):
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
 
-    def mark_downloaded(self, file_key, file_hash, file_size):
-        self.status['downloaded'][file_key] = {
-            'hash': file_hash,
-            'size': file_size,
-            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
-        self.save_status()
+def run_pipeline(source, staging_limit=None, download_workers=None, upload_workers=None):
+    """非交互的流水线迁移：列举 → 下载(同时计算hash) → 上传 → 校验 → 删除本地文件
 
-    def mark_uploaded(self, file_key, file_hash):
-        self.status['uploaded'][file_key] = {
-            'hash': file_hash,
-            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
-        self.save_status()
+    各阶段之间使用有界队列连接，本地暂存字节数超过staging_limit时暂停新的下载，
+    因此比本地磁盘更大的bucket也能一次跑完。返回(成功数, 失败数)。
+    """
+    is_ali = source == 'aliyun'
+    staging_limit = staging_limit or get_setting('pipeline', 'staging_limit', 10 * 1024 ** 3)
+    download_workers = download_workers or get_setting('transfer', f'{source}_workers', 8)
+    upload_workers = upload_workers or get_upload_settings()[2]
+    queue_size = get_setting('pipeline', 'queue_size', 1000)
 
-    def mark_failed(self, file_key, error):
-        self.status['failed'][file_key] = {
-            'error': str(error),
-            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
-        self.save_status()
+    status_tracker = FileStatus(source)
+    minio_client = create_minio_client()
+    budget = StagingBudget(staging_limit)
+    stats = TransferStats()
+    download_q = queue.Queue(maxsize=queue_size)
+    upload_q = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    counts = {'succeeded': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+    errors = []
+    progress = tqdm(desc="流水线进度", unit='个')
 
-def get_file_hash(filepath):
-    """计算文件的MD5值"""
-    hash_md5 = hashlib.md5()
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    def finish(success):
+        with counts_lock:
+            counts['succeeded' if success else 'failed'] += 1
+        progress.update(1)
 
-def init_clients():
-    """初始化所有客户端"""
-    try:
-        # 初始化阿里云客户端
-        auth = oss2.Auth(ali_access_key, ali_access_secret)
-        ali_client = oss2.Bucket(auth, ali_endpoint, ali_bucket)
-        
-        # 初始化腾讯云客户端
-        config = CosConfig(Region=tx_region, SecretId=tx_secret_id, SecretKey=tx_secret_key)
-        tx_client = CosS3Client(config)
-        
-        # 初始化MinIO客户端
-        minio_client = Minio(
-            minio_endpoint,
-            access_key=minio_access_key,
-            secret_key=minio_secret_key,
-            secure=minio_secure
-        )
-        
-        return ali_client, tx_client, minio_client
-    except Exception as e:
-        print(f"初始化客户端时出错: {str(e)}")
-        return None, None, None
+    def lister():
+        try:
+            client = get_thread_client(is_ali)
+            for obj in iter_source_objects(client, is_ali):
+                if obj['key'] in status_tracker.status['uploaded']:
+                    continue
+                if not budget.acquire(obj['size'], stop):
+                    break
+                if not _put_until_stopped(download_q, obj, stop):
+                    budget.release(obj['size'])
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            for _ in range(download_workers):
+                download_q.put(None)
 
-def get_ali_files(ali_client):
-    """获取阿里云OSS的文件列表"""
-    print("\n正在获取阿里云OSS文件列表...")
-    ali_files = []
-    try:
-        for obj in oss2.ObjectIterator(ali_client):
-            # 跳过以'/'结尾的对象（目录）
-            if not obj.key.endswith('/'):
-                ali_files.append(obj.key)
-        print(f"找到 {len(ali_files)} 个文件")
-        return ali_files
-    except Exception as e:
-        print(f"获取阿里云文件列表失败: {str(e)}")
-        return []
+    def downloader():
+        while True:
+            obj = download_q.get()
+            if obj is None:
+                break
+            success, path, file_hash, size = download_file(
+                get_thread_client(is_ali), obj['key'], is_ali, status_tracker, verbose=False, stage='pipeline',
+                size_hint=obj['size']
+            )
+            if success:
+                upload_q.put((obj, path))
+            else:
+                budget.release(obj['size'])
+                finish(False)
 
-def get_tx_files(tx_client):
-    """获取腾讯云COS的文件列表"""
-    print("\n正在获取腾讯云COS文件列表...")
-    tx_files = []
-    try:
-        marker = ""
+    def uploader():
         while True:
-            response = tx_client.list_objects(tx_bucket, Marker=marker)
-            if 'Contents' in response:
-                for content in response['Contents']:
-                    # 跳过以'/'结尾的对象（目录）
-                    if not content['Key'].endswith('/'):
-                        tx_files.append(content['Key'])
-            if response['IsTruncated'] == 'false':
+            item = upload_q.get()
+            if item is None:
                 break
-            marker = response['NextMarker']
-        print(f"找到 {len(tx_files)} 个文件")
-        return tx_files
-    except Exception as e:
-        print(f"获取腾讯云文件列表失败: {str(e)}")
-        return []
+            obj, path = item
+            start = time.monotonic()
+            success, error = upload_staged_file(minio_client, obj['key'], path, status_tracker, stage='pipeline')
+            if success:
+                stats.add(obj['key'], obj['size'], time.monotonic() - start)
+            else:
+                tqdm.write(f"上传失败: {obj['key']} - {error}")
+            # 上传并校验通过后删除本地暂存文件，释放磁盘空间；上传失败的文件同样删除，
+            # 否则持续失败时磁盘占用会超过水位。失败记录的阶段为pipeline，重试时同样下载、上传后删除
+            if os.path.exists(path):
+                os.remove(path)
+            budget.release(obj['size'])
+            finish(success)
 
-def get_file_info(file_path):
-    """获取文件信息（大小和哈希值）"""
-    if not os.path.exists(file_path):
-        return None, None
-    
-    size = os.path.getsize(file_path)
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return size, hash_md5.hexdigest()
+    # 使用守护线程，Ctrl+C时直接退出，未记录状态的对象下次运行会重新迁移
+    list_thread = threading.Thread(target=lister, name='pipeline-list', daemon=True)
+    download_threads = [
+        threading.Thread(target=downloader, name=f'pipeline-download-{i}', daemon=True)
+        for i in range(download_workers)
+    ]
+    upload_threads = [
+        threading.Thread(target=uploader, name=f'pipeline-upload-{i}', daemon=True)
+        for i in range(upload_workers)
+    ]
+    for thread in [list_thread] + download_threads + upload_threads:
+        thread.start()
+    try:
+        list_thread.join()
+        for thread in download_threads:
+            thread.join()
+        for _ in upload_threads:
+            upload_q.put(None)
+        for thread in upload_threads:
+            thread.join()
+    except KeyboardInterrupt:
+        stop.set()
+        print("\n流水线已中断")
+        raise
+    finally:
+        progress.close()
+        status_tracker.save_status()
 
-def get_download_path(file_key, source):
-    """获取下载文件的本地保存路径"""
-    # 根据来源创建对应的下载目录
-    base_dir = os.path.join('downloads', source)
-    # 保持原始路径结构
-    full_path = os.path.join(base_dir, file_key)
-    # 确保目录存在
-    os.makedirs(os.path.dirname(full_path), exist_ok=True)
-    return full_path
+    if errors:
+        print(f"列举源端文件失败: {str(errors[0])}")
+    print(f"流水线完成: 成功 {counts['succeeded']} 个, 失败 {counts['failed']} 个")
+    stats.summary()
+    return counts['succeeded'], counts['failed']
 
-def download_file(client, file_key, is_ali=True, status_tracker=None):
-    """下载单个文件并记录状态"""
-    try:
-        # 根据来源确定存路径
-        source = 'aliyun' if is_ali else 'tencent'
-        file_path = get_download_path(file_key, source)
-        
-        # 检查是否已经下载
-        if status_tracker and file_key in status_tracker.status['downloaded']:
-            existing_info = status_tracker.status['downloaded'][file_key]
-            if os.path.exists(file_path):
-                size, file_hash = get_file_info(file_path)
-                if file_hash == existing_info['hash']:
-                    print(f"文件已存在且校验通过: {file_key}")
-                    return True, file_path, file_hash, size
-        
-        print(f"开始下载: {file_key}")
-        if is_ali:
-            client.get_object_to_file(file_key, file_path)
-        else:
-            client.download_file(
-                Bucket=tx_bucket,
-                Key=file_key,
-                DestFilePath=file_path
+def retry_failed(source, status_tracker, minio_client, force=False, workers=None):
+    """直接从失败记录重新执行失败的对象，不需要重新列举bucket
+
+    默认只重试可重试、未超过retry.max_attempts且已过退避时间的对象，
+    force为True时重试全部失败对象。成功后失败记录会被自动清除。
+    """
+    is_ali = source == 'aliyun'
+    max_attempts = get_setting('retry', 'max_attempts', 5)
+    workers = workers or get_setting('transfer', f'{source}_workers', 8)
+    now = time.time()
+    eligible = []
+    waiting = skipped = 0
+    with status_tracker.lock:
+        failed = list(status_tracker.status['failed'].items())
+    for file_key, info in failed:
+        if not force:
+            if info.get('class') == 'permanent' or info.get('attempts', 0) >= max_attempts:
+                skipped += 1
+                continue
+            if info.get('next_retry', 0) > now:
+                waiting += 1
+                continue
+        eligible.append((file_key, info.get('stage', 'download')))
+    print(f"待重试 {len(eligible)} 个, 退避等待中 {waiting} 个, 跳过(不可重试或超过次数) {skipped} 个")
+    if not eligible:
+        return 0, 0
+
+    def worker(item):
+        file_key, stage = item
+        if stage == 'transfer':
+            success, _, size = transfer_file(
+                get_thread_client(is_ali), minio_client, file_key, is_ali, status_tracker, verbose=False
             )
-        
-        size, file_hash = get_file_info(file_path)
-        
-        if status_tracker:
-            status_tracker.mark_downloaded(file_key, file_hash, size)
-        
-        return True, file_path, file_hash, size
-    except Exception as e:
-        if status_tracker:
-            status_tracker.mark_failed(file_key, str(e))
-        print(f"下载失败: {str(e)}")
-        return False, None, None, None
+            return success, size
+        success, path, _, size = download_file(
+            get_thread_client(is_ali), file_key, is_ali, status_tracker, verbose=False, stage=stage
+        )
+        if success and stage in ('upload', 'pipeline'):
+            success, error = upload_staged_file(minio_client, file_key, path, status_tracker, stage=stage)
+        # 流水线中失败的对象按流水线的方式重试：上传后删除本地暂存文件
+        if stage == 'pipeline' and path and os.path.exists(path):
+            os.remove(path)
+        return success, size
 
-def verify_minio_upload(minio_client, remote_path, local_file):
-    """验证MinIO上传是否成功"""
-    try:
-        # 获取MinIO中文件的信息
-        stat = minio_client.stat_object(minio_bucket, remote_path)
-        # 获取本地文件信息
-        local_size, local_hash = get_file_info(local_file)
-        # 比较大小
-        if stat.size != local_size:
-            return False, "文件大小不匹配"
-        return True, None
-    except Exception as e:
-        return False, str(e)
+    succeeded, failed, _ = run_with_progress(worker, eligible, workers, "重试进度")
+    status_tracker.save_status()
+    print(f"重试完成: 成功 {succeeded} 个, 仍失败 {failed} 个")
+    return succeeded, failed
+
+def get_cluster_settings():
+    """返回(分片方式, 分片数, 协调存储路径, 分片状态目录, 租约秒数)"""
+    return (
+        get_setting('cluster', 'strategy', 'range'),
+        get_setting('cluster', 'shards', 64),
+        get_setting('cluster', 'coordinator', os.path.join('shards', 'leases.db')),
+        get_setting('cluster', 'status_dir', 'shards'),
+        get_setting('cluster', 'lease_seconds', 300)
+    )
+
+def shard_of(file_key, shard_count):
+    """按key的MD5把对象均匀分到各分片"""
+    return int(hashlib.md5(file_key.encode('utf-8')).hexdigest()[:8], 16) % shard_count
+
+def plan_shards(client, is_ali, strategy, shard_count):
+    """生成分片列表：range方式为各key范围的起始marker，hash方式为固定编号，prefix方式为根目录('')加各顶层前缀"""
+    if strategy == 'range':
+        return sample_range_markers(client, is_ali, shard_count)
+    if strategy == 'hash':
+        return [f"{index:04d}" for index in range(shard_count)]
+    if strategy == 'prefix':
+        shards = ['']
+        for _, prefixes in iter_source_pages(client, is_ali, delimiter='/'):
+            shards.extend(prefixes)
+        return shards
+    raise ValueError(f"未知的分片方式: {strategy}")
+
+def sample_range_markers(client, is_ali, shard_count):
+    """列举一遍源端，把key空间按对象数大致均分为shard_count个范围，返回各范围的起始marker
+
+    第一个范围的marker为''，每个范围包含(marker, 下一个marker]内的key。
+    采样间隔随对象数倍增，只保留不超过2*shard_count个key，内存占用与对象总数无关。
+    """
+    samples = []
+    stride = 1
+    seen = 0
+    for objects, _ in iter_source_pages(client, is_ali):
+        for obj in objects:
+            if seen % stride == 0:
+                samples.append(obj['key'])
+                if len(samples) >= 2 * shard_count:
+                    samples = samples[::2]
+                    stride *= 2
+            seen += 1
+    step = len(samples) / shard_count
+    markers = {samples[int(index * step)] for index in range(1, shard_count) if int(index * step) > 0}
+    return [''] + sorted(markers)
+
+def iter_shard_keys(client, is_ali, shard, strategy, shard_count, shards=None):
+    """列举属于某个分片的对象key
+
+    range方式从分片的marker开始列举到下一个分片的marker为止（shards为全部分片），
+    prefix方式只列举该前缀，hash方式每个分片都要完整列举一遍再过滤。
+    """
+    if strategy == 'range':
+        upper = min((other for other in shards if other > shard), default=None)
+        for objects, _ in iter_source_pages(client, is_ali, marker=shard):
+            for obj in objects:
+                if upper is not None and obj['key'] > upper:
+                    return
+                yield obj['key']
+    elif strategy == 'hash':
+        index = int(shard)
+        for obj in iter_source_objects(client, is_ali):
+            if shard_of(obj['key'], shard_count) == index:
+                yield obj['key']
+    elif shard == '':
+        for objects, _ in iter_source_pages(client, is_ali, delimiter='/'):
+            for obj in objects:
+                yield obj['key']
+    else:
+        for objects, _ in iter_source_pages(client, is_ali, shard):
+            for obj in objects:
+                yield obj['key']
+
+def shard_filename(shard):
+    """分片标识转换为可用作文件名的字符串"""
+    return quote(shard.rstrip('/'), safe='') or '_root'
+
+def get_shard_status_path(source, shard):
+    status_dir = get_cluster_settings()[3]
+    os.makedirs(status_dir, exist_ok=True)
+    return os.path.join(status_dir, f"{source}_{shard_filename(shard)}")
+
+class SqliteLeaseCoordinator:
+    """基于共享SQLite文件的分片租约
+
+    每次操作使用短连接和BEGIN IMMEDIATE事务，多台机器通过同一个文件协调。
+    网络文件系统上无法使用WAL的共享内存，因此保持默认的回滚日志模式。
+    """
+    def __init__(self, path, lease_seconds):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS leases (source TEXT, shard TEXT, owner TEXT, '
+                'expires REAL, done INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, '
+                'PRIMARY KEY (source, shard))'
+            )
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def ensure_shards(self, source, shards):
+        with self.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                'INSERT OR IGNORE INTO leases (source, shard) VALUES (?, ?)',
+                [(source, shard) for shard in shards]
+            )
+            conn.execute('COMMIT')
+
+    def register_plan(self, source, shards):
+        """登记分片划分，已有节点登记过时保留先登记的划分，返回生效的分片列表"""
+        with self.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if not conn.execute('SELECT 1 FROM leases WHERE source = ? LIMIT 1', (source,)).fetchone():
+                conn.executemany(
+                    'INSERT INTO leases (source, shard) VALUES (?, ?)',
+                    [(source, shard) for shard in shards]
+                )
+            rows = conn.execute('SELECT shard FROM leases WHERE source = ? ORDER BY shard', (source,)).fetchall()
+            conn.execute('COMMIT')
+        return [row[0] for row in rows]
+
+    def claim(self, source, owner):
+        """领取一个未完成且无人持有（或租约已过期）的分片，没有可领取的分片时返回None"""
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT shard FROM leases WHERE source = ? AND done = 0 '
+                'AND (owner IS NULL OR expires < ?) ORDER BY shard LIMIT 1',
+                (source, now)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    'UPDATE leases SET owner = ?, expires = ? WHERE source = ? AND shard = ?',
+                    (owner, now + self.lease_seconds, source, row[0])
+                )
+            conn.execute('COMMIT')
+        return row[0] if row else None
+
+    def renew(self, source, shard, owner):
+        """续约，租约已被其他节点收回时返回False"""
+        with self.connect() as conn:
+            cursor = conn.execute(
+                'UPDATE leases SET expires = ? WHERE source = ? AND shard = ? AND owner = ? AND done = 0',
+                (time.time() + self.lease_seconds, source, shard, owner)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, source, shard, owner, failed):
+        """标记分片完成，租约已被其他节点收回时不做修改并返回False"""
+        with self.connect() as conn:
+            cursor = conn.execute(
+                'UPDATE leases SET done = 1, failed = ? WHERE source = ? AND shard = ? AND owner = ? AND done = 0',
+                (failed, source, shard, owner)
+            )
+            return cursor.rowcount == 1
+
+    def progress(self, source):
+        """各分片的状态 [{'shard', 'owner', 'expires', 'done', 'failed'}]"""
+        with self.connect() as conn:
+            rows = conn.execute(
+                'SELECT shard, owner, expires, done, failed FROM leases WHERE source = ? ORDER BY shard',
+                (source,)
+            ).fetchall()
+        return [
+            {'shard': shard, 'owner': owner, 'expires': expires, 'done': bool(done), 'failed': failed}
+            for shard, owner, expires, done, failed in rows
+        ]
+
+class LockDirLeaseCoordinator:
+    """基于共享目录中锁文件的分片租约，适用于不支持SQLite文件锁的共享存储
+
+    <分片>.shard 登记分片，<分片>.lease 为租约（O_EXCL创建保证只有一个节点持有），
+    <分片>.done 表示已完成。收回过期租约时先把租约文件改名，确认改名得到的确实是
+    过期的那份后再重新创建，避免误删其他节点刚刚取得的租约。
+    """
+    def __init__(self, path, lease_seconds):
+        self.path = path
+        self.lease_seconds = lease_seconds
+
+    def shard_path(self, source, shard, suffix):
+        directory = os.path.join(self.path, source)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, shard_filename(shard) + suffix)
+
+    def read(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def ensure_shards(self, source, shards):
+        for shard in shards:
+            path = self.shard_path(source, shard, '.shard')
+            if os.path.exists(path):
+                continue
+            # 多个节点可能同时登记，各自使用独立的临时文件
+            tmp_path = f"{path}.{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'shard': shard}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+
+    def register_plan(self, source, shards):
+        """登记分片划分，已有节点登记过时保留先登记的划分，返回生效的分片列表
+
+        划分先完整写入临时文件，再用os.link创建plan.json，只有第一个节点能创建成功。
+        """
+        directory = os.path.join(self.path, source)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'plan.json')
+        tmp_path = f"{path}.{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'shards': shards}, f, ensure_ascii=False)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+        shards = self.read(path)['shards']
+        # 先登记划分的节点可能在创建分片文件前退出，每个节点都补齐一遍
+        self.ensure_shards(source, shards)
+        return shards
+
+    def registered_shards(self, source):
+        directory = os.path.join(self.path, source)
+        if not os.path.isdir(directory):
+            return []
+        shards = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.shard'):
+                info = self.read(os.path.join(directory, name))
+                if info is not None:
+                    shards.append(info['shard'])
+        return shards
+
+    def try_create_lease(self, path, owner):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'owner': owner, 'expires': time.time() + self.lease_seconds}, f)
+        return True
+
+    def reclaim(self, path, expired, owner):
+        """收回过期租约，改名后发现拿到的不是过期的那份时放回原处"""
+        stale_path = f"{path}.stale-{owner}"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return
+        if self.read(stale_path) != expired:
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+        os.remove(stale_path)
+
+    def claim(self, source, owner):
+        """领取一个未完成且无人持有（或租约已过期）的分片，没有可领取的分片时返回None"""
+        for shard in self.registered_shards(source):
+            if os.path.exists(self.shard_path(source, shard, '.done')):
+                continue
+            lease_path = self.shard_path(source, shard, '.lease')
+            if self.try_create_lease(lease_path, owner):
+                return shard
+            lease = self.read(lease_path)
+            if lease and lease['expires'] < time.time():
+                self.reclaim(lease_path, lease, owner)
+                if self.try_create_lease(lease_path, owner):
+                    return shard
+        return None
+
+    def renew(self, source, shard, owner):
+        """续约，租约已被其他节点收回时返回False"""
+        lease_path = self.shard_path(source, shard, '.lease')
+        lease = self.read(lease_path)
+        if not lease or lease['owner'] != owner:
+            return False
+        write_json_atomic(lease_path, {'owner': owner, 'expires': time.time() + self.lease_seconds})
+        return True
+
+    def complete(self, source, shard, owner, failed):
+        """标记分片完成，租约已被其他节点收回时不做修改并返回False
+
+        先把租约文件改名为自己独占的文件再确认持有者，不会删除其他节点的租约。
+        """
+        lease_path = self.shard_path(source, shard, '.lease')
+        held_path = f"{lease_path}.done-{owner}"
+        try:
+            os.rename(lease_path, held_path)
+        except FileNotFoundError:
+            return False
+        lease = self.read(held_path)
+        if not lease or lease['owner'] != owner:
+            try:
+                os.link(held_path, lease_path)
+            except FileExistsError:
+                pass
+            os.remove(held_path)
+            return False
+        write_json_atomic(self.shard_path(source, shard, '.done'), {'owner': owner, 'failed': failed})
+        os.remove(held_path)
+        return True
+
+    def progress(self, source):
+        """各分片的状态 [{'shard', 'owner', 'expires', 'done', 'failed'}]"""
+        result = []
+        for shard in self.registered_shards(source):
+            done = self.read(self.shard_path(source, shard, '.done'))
+            lease = self.read(self.shard_path(source, shard, '.lease')) or {}
+            result.append({
+                'shard': shard,
+                'owner': (done or lease).get('owner'),
+                'expires': lease.get('expires'),
+                'done': done is not None,
+                'failed': (done or {}).get('failed', 0)
+            })
+        return result
+
+def create_coordinator():
+    """根据配置创建分片协调器：路径以.db结尾时使用SQLite，否则使用锁文件目录"""
+    _, _, path, _, lease_seconds = get_cluster_settings()
+    if path.endswith('.db'):
+        return SqliteLeaseCoordinator(path, lease_seconds)
+    return LockDirLeaseCoordinator(path, lease_seconds)
+
+def keep_lease(coordinator, source, shard, owner, stop, lost):
+    """后台定期续约，租约被收回或超过租期仍未续约成功时设置lost，让本节点停止处理该分片"""
+    interval = max(coordinator.lease_seconds / 3, 1)
+    renewed = time.monotonic()
+    while not stop.wait(interval):
+        try:
+            if not coordinator.renew(source, shard, owner):
+                tqdm.write(f"警告: 分片 {shard!r} 的租约已被其他节点收回，停止处理")
+                lost.set()
+                return
+            renewed = time.monotonic()
+        except Exception as e:
+            tqdm.write(f"续约分片 {shard!r} 时出错: {str(e)}")
+            if time.monotonic() - renewed > coordinator.lease_seconds:
+                tqdm.write(f"警告: 分片 {shard!r} 的租约已过期，停止处理")
+                lost.set()
+                return
+
+def iter_until(items, event):
+    """逐个产出items，event被设置后停止"""
+    for item in items:
+        if event.is_set():
+            return
+        yield item
+
+def run_worker(source, workers=None, worker_id=None):
+    """分片工作节点：循环领取分片并直接迁移，直到所有分片完成
+
+    返回(完成的分片数, 失败的对象数)。
+    """
+    is_ali = source == 'aliyun'
+    strategy, shard_count, _, _, _ = get_cluster_settings()
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    client = create_ali_client() if is_ali else create_tx_client()
+    minio_client = create_minio_client()
+    coordinator = create_coordinator()
+    if strategy != 'range':
+        coordinator.ensure_shards(source, plan_shards(client, is_ali, strategy, shard_count))
+    elif not coordinator.progress(source):
+        # range方式的划分需要列举一遍源端，已有节点登记过时直接沿用；
+        # 多个节点同时划分时只有最先登记的划分生效，不会混入其他节点采样的marker
+        coordinator.register_plan(source, plan_shards(client, is_ali, strategy, shard_count))
+    print(f"工作节点 {worker_id} 已启动，分片方式: {strategy}")
+
+    completed = total_failed = 0
+    while True:
+        shard = coordinator.claim(source, worker_id)
+        if shard is None:
+            pending = [item for item in coordinator.progress(source) if not item['done']]
+            if not pending:
+                break
+            # 剩余分片都被其他节点持有，等待完成或租约过期
+            time.sleep(min(coordinator.lease_seconds / 3, 30))
+            continue
+
+        print(f"\n领取分片 {shard!r}")
+        stop = threading.Event()
+        lost = threading.Event()
+        heartbeat = threading.Thread(
+            target=keep_lease, args=(coordinator, source, shard, worker_id, stop, lost),
+            name='lease', daemon=True
+        )
+        heartbeat.start()
+        tracker = FileStatus(get_shard_status_path(source, shard))
+        try:
+            # 租约丢失后不再提交新的对象，已在传输中的对象完成后退出
+            shards = [item['shard'] for item in coordinator.progress(source)]
+            keys = iter_until(iter_shard_keys(client, is_ali, shard, strategy, shard_count, shards), lost)
+            _, failed, _ = transfer_all(keys, is_ali, tracker, minio_client, workers)
+        finally:
+            stop.set()
+            tracker.close()
+        if lost.is_set() or not coordinator.complete(source, shard, worker_id, failed):
+            print(f"分片 {shard!r} 已由其他节点持有，本节点放弃")
+            continue
+        completed += 1
+        total_failed += failed
+
+    print(f"\n工作节点 {worker_id} 完成: 处理分片 {completed} 个, 失败对象 {total_failed} 个")
+    return completed, total_failed
+
+STATUS_SUFFIXES = ('_status.json', '_status.journal', '_status.db')
+
+def merge_shard_status(source, status_tracker):
+    """把各分片的状态合并到来源的总状态中，返回合并的分片数
+
+    先合并失败记录再合并上传记录，已上传的对象会清除其失败记录。
+    """
+    status_dir = get_cluster_settings()[3]
+    if not os.path.isdir(status_dir):
+        return 0
+    bases = sorted({
+        os.path.join(status_dir, name[:-len(suffix)])
+        for name in os.listdir(status_dir) if name.startswith(f"{source}_")
+        for suffix in STATUS_SUFFIXES if name.endswith(suffix)
+    })
+    for base in bases:
+        shard_status = FileStatus(base)
+        for section in ('downloaded', 'failed', 'uploaded'):
+            merged = status_tracker.status[section]
+            for file_key, info in shard_status.status[section].items():
+                # 重复合并时跳过未变化的记录，避免状态日志每次都追加整份分片状态
+                if merged.get(file_key) != info:
+                    status_tracker.record(section, file_key, info)
+                if section == 'uploaded' and file_key in status_tracker.status['failed']:
+                    status_tracker.record('failed', file_key, None)
+        shard_status.close()
+    status_tracker.save_status()
+    return len(bases)
+
+def show_shard_progress(source):
+    """显示各分片的完成情况"""
+    progress = create_coordinator().progress(source)
+    if not progress:
+        print("没有分片记录")
+        return
+    done = sum(1 for item in progress if item['done'])
+    print(f"\n=== 分片进度: {done}/{len(progress)} 已完成 ===")
+    now = time.time()
+    for item in progress:
+        if item['done']:
+            state = f"已完成 ({item['owner']}, 失败 {item['failed']} 个)"
+        elif item['owner'] and item['expires'] and item['expires'] >= now:
+            state = f"进行中 ({item['owner']})"
+        else:
+            state = "待处理"
+        print(f"- {item['shard'] or '<根目录>'}: {state}")
 
 def show_migration_summary(status_tracker):
     """显示迁移总结"""
+    # 后台核对下载目录时会修改状态，先在锁内取快照再显示
+    with status_tracker.lock:
+        downloaded = len(status_tracker.status['downloaded'])
+        uploaded = len(status_tracker.status['uploaded'])
+        failed = list(status_tracker.status['failed'].items())
     print("\n=== 迁移状态总结 ===")
-    print(f"总下载文件数: {len(status_tracker.status['downloaded'])}")
-    print(f"总上传文件数: {len(status_tracker.status['uploaded'])}")
-    print(f"失败文件数: {len(status_tracker.status['failed'])}")
+    print(f"总下载文件数: {downloaded}")
+    print(f"总上传文件数: {uploaded}")
+    print(f"失败文件数: {len(failed)}")
     
-    if status_tracker.status['failed']:
+    if failed:
         print("\n失败的文件:")
-        for file_key, info in status_tracker.status['failed'].items():
-            print(f"- {file_key}: {info['error']}")
+        for file_key, info in failed:
+            detail = ''
+            if 'attempts' in info:
+                error_class = '可重试' if info['class'] == 'transient' else '不可重试'
+                detail = f" [{info['stage']}, {error_class}, 已尝试 {info['attempts']} 次]"
+            print(f"- {file_key}: {info['error']}{detail}")
+
+def iter_local_files(base_dir):
+    """递归遍历目录，产出(完整路径, stat结果)，跳过隐藏文件和临时文件"""
+    stack = [base_dir]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file():
+                if entry.name.startswith('.') or entry.name.endswith('.tmp'):
+                    continue
+                yield entry.path, entry.stat()
+
+# 退出程序时通知后台扫描停止
+scan_stop = threading.Event()
+
+def reconcile_downloads(source, status_tracker, workers=None):
+    """增量核对下载目录：指纹与记录一致的文件只做stat，新增或变化的文件才计算hash
+
+    返回(重新计算hash的文件数, 跳过的文件数)。
+    """
+    base_dir = os.path.join('downloads', source)
+    workers = workers or get_setting('transfer', 'scan_workers', 4)
+    downloaded = status_tracker.status['downloaded']
+    skipped = 0
+
+    def changed_files():
+        nonlocal skipped
+        for full_path, stat_result in iter_local_files(base_dir):
+            if scan_stop.is_set():
+                return
+            relative_path = os.path.relpath(full_path, base_dir)
+            fingerprint = get_fingerprint(stat_result)
+            record = downloaded.get(relative_path)
+            if record and record.get('fingerprint') == fingerprint:
+                skipped += 1
+                continue
+            yield relative_path, full_path, fingerprint
+
+    def worker(item):
+        relative_path, full_path, fingerprint = item
+        size, file_hash = get_file_info(full_path)
+        status_tracker.mark_downloaded(relative_path, file_hash, size, fingerprint)
 
-def check_existing_downloads():
-    """检查并记录已存在的下载文件"""
+    hashed = 0
+    for _ in bounded_map(worker, changed_files(), workers):
+        hashed += 1
+    status_tracker.save_status()
+    return hashed, skipped
+
+def check_existing_downloads(background=False):
+    """检查并记录已存在的下载文件，background为True时在后台线程中核对"""
     ali_status = FileStatus('aliyun')
     tx_status = FileStatus('tencent')
-    
-    # 检查阿里云下载目录
-    ali_dir = os.path.join('downloads', 'aliyun')
-    if os.path.exists(ali_dir):
-        for root, _, files in os.walk(ali_dir):
-            for file in files:
-                full_path = os.path.join(root, file)
-                # 跳过隐藏文件和临时文件
-                if file.startswith('.') or file.endswith('.tmp'):
-                    continue
-                relative_path = os.path.relpath(full_path, ali_dir)
-                size, file_hash = get_file_info(full_path)
-                ali_status.mark_downloaded(relative_path, file_hash, size)
-    
-    # 检查腾讯云下载目录
-    tx_dir = os.path.join('downloads', 'tencent')
-    if os.path.exists(tx_dir):
-        for root, _, files in os.walk(tx_dir):
-            for file in files:
-                full_path = os.path.join(root, file)
-                # 跳过隐藏文件和临时文件
-                if file.startswith('.') or file.endswith('.tmp'):
-                    continue
-                relative_path = os.path.relpath(full_path, tx_dir)
-                size, file_hash = get_file_info(full_path)
-                tx_status.mark_downloaded(relative_path, file_hash, size)
-    
+
+    def scan():
+        for name, source, status_tracker in (('阿里云', 'aliyun', ali_status),
+                                             ('腾讯云', 'tencent', tx_status)):
+            try:
+                hashed, skipped = reconcile_downloads(source, status_tracker)
+                if hashed:
+                    print(f"\n{name}下载目录核对完成: 更新 {hashed} 个, 未变化 {skipped} 个")
+            except Exception as e:
+                print(f"\n检查{name}下载目录失败: {str(e)}")
+
+    if background:
+        threading.Thread(target=scan, name='startup-scan', daemon=True).start()
+    else:
+        scan()
     return ali_status, tx_status
 
 def test_minio_upload():
@@ -290,36 +3283,31 @@ def test_minio_upload():
         
         # 初始化MinIO客户端
         print("2. 连接MinIO服务器...")
-        minio_client = Minio(
-            minio_endpoint,
-            access_key=minio_access_key,
-            secret_key=minio_secret_key,
-            secure=minio_secure
-        )
+        minio_client = create_minio_client()
         
         # 确保bucket存在
         print("3. 检查bucket...")
-        if not minio_client.bucket_exists(minio_bucket):
-            minio_client.make_bucket(minio_bucket)
-            print(f"创建bucket: {minio_bucket}")
+        if not minio_client.bucket_exists(get_required('minio', 'bucket')):
+            minio_client.make_bucket(get_required('minio', 'bucket'))
+            print(f"创建bucket: {get_required('minio', 'bucket')}")
         else:
-            print(f"bucket已存在: {minio_bucket}")
+            print(f"bucket已存在: {get_required('minio', 'bucket')}")
         
         # 上传文件
         print("4. 上传测试文件...")
-        minio_client.fput_object(minio_bucket, test_remote_path, test_file)
+        minio_client.fput_object(get_required('minio', 'bucket'), test_remote_path, test_file)
         
         # 验证上传
         print("5. 验证上传...")
         try:
-            stat = minio_client.stat_object(minio_bucket, test_remote_path)
+            stat = minio_client.stat_object(get_required('minio', 'bucket'), test_remote_path)
             print(f"文件大小: {stat.size} 字节")
             print(f"上传时间: {stat.last_modified}")
             
             # 下载并验��内容
             print("6. 验证文件内容...")
             test_download = "minio_test_download.txt"
-            minio_client.fget_object(minio_bucket, test_remote_path, test_download)
+            minio_client.fget_object(get_required('minio', 'bucket'), test_remote_path, test_download)
             
             with open(test_download, 'r', encoding='utf-8') as f:
                 downloaded_content = f.read()
@@ -333,7 +3321,7 @@ def test_minio_upload():
             print("7. 清理测试文件...")
             os.remove(test_file)
             os.remove(test_download)
-            minio_client.remove_object(minio_bucket, test_remote_path)
+            minio_client.remove_object(get_required('minio', 'bucket'), test_remote_path)
             
             print("\n测试完成：MinIO配置正常，可开始迁移！")
             return True
@@ -356,13 +3344,10 @@ def main():
     # 初始化客户端
     print("正在初始化客户端...")
     ali_client, tx_client, minio_client = init_clients()
-    if not all([ali_client, tx_client, minio_client]):
-        print("初始化失败，程序退出")
-        return
 
-    # 检查已存在的下载文件
-    print("正在检查已下载的文件...")
-    ali_status, tx_status = check_existing_downloads()
+    # 在后台增量核对已下载的文件，不阻塞菜单
+    print("正在后台检查已下载的文件...")
+    ali_status, tx_status = check_existing_downloads(background=True)
 
     while True:
         print("\n=== 文件迁移工具 ===")
@@ -376,119 +3361,54 @@ def main():
         print("7. ��看迁移状态")
         print("8. 验证已上传文件")
         print("9. 测试MinIO上传")
+        print("10. 直接迁移到MinIO(不落盘)")
+        print("11. 增量同步到MinIO")
+        print("12. 重试失败的文件")
         print("0. 退出")
         
-        choice = input("\n请选择操作 (0-9): ")
+        choice = input("\n请选择操作 (0-12): ")
         
         if choice == '1':
-            files = get_ali_files(ali_client)
-            print("\n文件列表：")
-            for i, f in enumerate(files, 1):
-                status = "已下载" if f in ali_status.status['downloaded'] else "未下载"
-                print(f"{i}. {f} [{status}]")
+            browse_source_files(ali_client, True, ali_status, selectable=False)
         
         elif choice == '2':
-            files = get_tx_files(tx_client)
-            print("\n文件列表：")
-            for i, f in enumerate(files, 1):
-                status = "已下载" if f in tx_status.status['downloaded'] else "未下载"
-                print(f"{i}. {f} [{status}]")
+            browse_source_files(tx_client, False, tx_status, selectable=False)
         
         elif choice == '3':
-            files = get_ali_files(ali_client)
+            files, sizes = browse_source_files(ali_client, True, ali_status)
             if not files:
                 continue
-                
-            print("\n可下载的文件：")
-            for i, f in enumerate(files, 1):
-                status = "已下载" if f in ali_status.status['downloaded'] else "未下载"
-                print(f"{i}. {f} [{status}]")
-                
-            idx = input("\n请选择要下载的文件序号 (输入all下载全部): ")
-            if idx.lower() == 'all':
-                for f in tqdm(files, desc="下载进度"):
-                    if f not in ali_status.status['downloaded']:
-                        success, path, file_hash, size = download_file(
-                            ali_client, f, True, ali_status
-                        )
-                        if success:
-                            print(f"\n成功下载: {f}")
-                            print(f"保存位置: {path}")
-                            print(f"文件大小: {size/1024:.2f}KB")
-                            print(f"文件Hash: {file_hash}")
+            if len(files) > 1:
+                download_all(files, True, ali_status, sizes=sizes)
             else:
-                try:
-                    idx = int(idx) - 1
-                    if 0 <= idx < len(files):
-                        success, path, file_hash, size = download_file(
-                            ali_client, files[idx], True, ali_status
-                        )
-                        if success:
-                            print(f"成功下载: {files[idx]}")
-                            print(f"保存位置: {path}")
-                            print(f"文件大小: {size/1024:.2f}KB")
-                            print(f"文件Hash: {file_hash}")
-                except ValueError:
-                    print("无效的输入")
+                success, path, file_hash, size = download_file(
+                    ali_client, files[0], True, ali_status
+                )
+                if success:
+                    print(f"成功下载: {files[0]}")
+                    print(f"保存位置: {path}")
+                    print(f"文件大小: {size/1024:.2f}KB")
+                    print(f"文件Hash: {file_hash}")
         
         elif choice == '4':
-            files = get_tx_files(tx_client)
+            files, sizes = browse_source_files(tx_client, False, tx_status)
             if not files:
                 continue
-                
-            print("\n可下载的文件：")
-            for i, f in enumerate(files, 1):
-                status = "已下载" if f in tx_status.status['downloaded'] else "未下载"
-                print(f"{i}. {f} [{status}]")
-                
-            idx = input("\n请选择要下载的文件序号 (输入all下载全部): ")
-            if idx.lower() == 'all':
-                for f in tqdm(files, desc="下载进度"):
-                    if f not in tx_status.status['downloaded']:
-                        success, path, file_hash, size = download_file(
-                            tx_client, f, False, tx_status
-                        )
-                        if success:
-                            print(f"\n成功下载: {f}")
-                            print(f"保存位置: {path}")
-                            print(f"文件大小: {size/1024:.2f}KB")
-                            print(f"文件Hash: {file_hash}")
+            if len(files) > 1:
+                download_all(files, False, tx_status, sizes=sizes)
             else:
-                try:
-                    idx = int(idx) - 1
-                    if 0 <= idx < len(files):
-                        success, path, file_hash, size = download_file(
-                            tx_client, files[idx], False, tx_status
-                        )
-                        if success:
-                            print(f"成功下载: {files[idx]}")
-                            print(f"保存位置: {path}")
-                            print(f"文件大小: {size/1024:.2f}KB")
-                            print(f"文件Hash: {file_hash}")
-                except ValueError:
-                    print("无效的输入")
+                success, path, file_hash, size = download_file(
+                    tx_client, files[0], False, tx_status
+                )
+                if success:
+                    print(f"成功下载: {files[0]}")
+                    print(f"保存位置: {path}")
+                    print(f"文件大小: {size/1024:.2f}KB")
+                    print(f"文件Hash: {file_hash}")
         
         elif choice == '5':
             print("\n正在扫描下载目录...")
-            all_files = []
-            
-            # 扫描阿里云目录
-            ali_dir = os.path.join('downloads', 'aliyun')
-            if os.path.exists(ali_dir):
-                for root, _, files in os.walk(ali_dir):
-                    for file in files:
-                        full_path = os.path.join(root, file)
-                        relative_path = os.path.relpath(full_path, ali_dir)
-                        all_files.append(('aliyun', relative_path, full_path))
-            
-            # 扫描腾讯云目录
-            tx_dir = os.path.join('downloads', 'tencent')
-            if os.path.exists(tx_dir):
-                for root, _, files in os.walk(tx_dir):
-                    for file in files:
-                        full_path = os.path.join(root, file)
-                        relative_path = os.path.relpath(full_path, tx_dir)
-                        all_files.append(('tencent', relative_path, full_path))
+            all_files = list_staged_files('aliyun') + list_staged_files('tencent')
             
             if not all_files:
                 print("没有找到可上传的文件")
@@ -496,28 +3416,14 @@ def main():
             
             print("\n可上传的文件：")
             for i, (source, relative_path, full_path) in enumerate(all_files, 1):
-                size, _ = get_file_info(full_path)
+                size = os.path.getsize(full_path)
                 status_tracker = ali_status if source == 'aliyun' else tx_status
                 uploaded = "已上传" if relative_path in status_tracker.status['uploaded'] else "未上传"
                 print(f"{i}. [{source}] {relative_path} ({size/1024:.2f}KB) [{uploaded}]")
             
             idx = input("\n请选择要上传的文件序号 (输入all上传全部): ")
             if idx.lower() == 'all':
-                for source, relative_path, full_path in tqdm(all_files, desc="上传进度"):
-                    status_tracker = ali_status if source == 'aliyun' else tx_status
-                    if relative_path not in status_tracker.status['uploaded']:
-                        print(f"\n正在上传: [{source}] {relative_path}")
-                        try:
-                            minio_client.fput_object(minio_bucket, relative_path, full_path)
-                            success, error = verify_minio_upload(minio_client, relative_path, full_path)
-                            if success:
-                                print("上传成功并验证通过")
-                                size, file_hash = get_file_info(full_path)
-                                status_tracker.mark_uploaded(relative_path, file_hash)
-                            else:
-                                print(f"上传验证失败: {error}")
-                        except Exception as e:
-                            print(f"上传失败: {str(e)}")
+                upload_all(all_files, ali_status, tx_status, minio_client)
             else:
                 try:
                     idx = int(idx) - 1
@@ -525,17 +3431,13 @@ def main():
                         source, relative_path, full_path = all_files[idx]
                         status_tracker = ali_status if source == 'aliyun' else tx_status
                         print(f"\n正在上传: [{source}] {relative_path}")
-                        try:
-                            minio_client.fput_object(minio_bucket, relative_path, full_path)
-                            success, error = verify_minio_upload(minio_client, relative_path, full_path)
-                            if success:
-                                print("上传成功并验证通过")
-                                size, file_hash = get_file_info(full_path)
-                                status_tracker.mark_uploaded(relative_path, file_hash)
-                            else:
-                                print(f"上传验证失败: {error}")
-                        except Exception as e:
-                            print(f"上传失败: {str(e)}")
+                        success, error = upload_staged_file(
+                            minio_client, relative_path, full_path, status_tracker
+                        )
+                        if success:
+                            print("上传成功并验证通过")
+                        else:
+                            print(f"上传失败: {error}")
                 except ValueError:
                     print("无效的输入")
         
@@ -550,7 +3452,7 @@ def main():
                     for file in files:
                         full_path = os.path.join(root, file)
                         relative_path = os.path.relpath(full_path, ali_dir)
-                        size, file_hash = get_file_info(full_path)
+                        size = os.path.getsize(full_path)
                         uploaded = "已上传" if relative_path in ali_status.status['uploaded'] else "未上传"
                         print(f"- {relative_path} ({size/1024:.2f}KB) [{uploaded}]")
             
@@ -562,7 +3464,7 @@ def main():
                     for file in files:
                         full_path = os.path.join(root, file)
                         relative_path = os.path.relpath(full_path, tx_dir)
-                        size, file_hash = get_file_info(full_path)
+                        size = os.path.getsize(full_path)
                         uploaded = "已上传" if relative_path in tx_status.status['uploaded'] else "未上传"
                         print(f"- {relative_path} ({size/1024:.2f}KB) [{uploaded}]")
         
@@ -571,30 +3473,189 @@ def main():
             show_migration_summary(ali_status)
             print("\n=== 腾讯云迁移状态 ===")
             show_migration_summary(tx_status)
+            cache_stats = get_hash_cache().stats()
+            print(f"\n哈希缓存: 命中 {cache_stats['hits']} 次, 未命中 {cache_stats['misses']} 次")
+            content_index = get_content_index()
+            if content_index:
+                dedup_stats = content_index.stats()
+                print(f"内容去重: 已索引 {dedup_stats['contents']} 份内容, 本次链接 {dedup_stats['linked']} 个, "
+                      f"服务端复制 {dedup_stats['copied']} 个, 节省 {dedup_stats['saved_bytes']/1024/1024:.2f}MB")
         
         elif choice == '8':
             print("\n开始验证已上传文件...")
-            all_uploaded = list(ali_status.status['uploaded'].keys()) + list(tx_status.status['uploaded'].keys())
-            for remote_path in tqdm(all_uploaded, desc="验证进度"):
-                local_path = os.path.join('downloads', remote_path.replace('/', '_'))
-                if os.path.exists(local_path):
-                    success, error = verify_minio_upload(minio_client, remote_path, local_path)
-                    if success:
-                        print(f"文件验证通过: {remote_path}")
-                    else:
-                        print(f"文件验证失���: {remote_path} - {error}")
-                else:
-                    print(f"本地文件不存在: {local_path}")
+            try:
+                verify_all(minio_client, {'aliyun': ali_status, 'tencent': tx_status})
+            except Exception as e:
+                print(f"验证失败: {str(e)}")
         
         elif choice == '9':
             test_minio_upload()
         
+        elif choice == '10':
+            source = input("\n请选择来源 (1: 阿里云, 2: 腾讯云): ")
+            if source not in ('1', '2'):
+                print("无效的输入")
+                continue
+            is_ali = source == '1'
+            client = ali_client if is_ali else tx_client
+            status_tracker = ali_status if is_ali else tx_status
+            files, sizes = browse_source_files(client, is_ali, status_tracker, 'uploaded')
+            if not files:
+                continue
+            if len(files) > 1:
+                transfer_all(files, is_ali, status_tracker, minio_client, sizes=sizes)
+            else:
+                success, file_hash, size = transfer_file(
+                    client, minio_client, files[0], is_ali, status_tracker
+                )
+                if success:
+                    print(f"成功迁移: {files[0]}")
+                    print(f"文件大小: {size/1024:.2f}KB")
+                    print(f"文件Hash: {file_hash}")
+        
+        elif choice == '11':
+            source = input("\n请选择来源 (1: 阿里云, 2: 腾讯云): ")
+            if source not in ('1', '2'):
+                print("无效的输入")
+                continue
+            is_ali = source == '1'
+            delete = input("是否删除MinIO中源端已不存在的对象? (y/N): ").lower() == 'y'
+            print("\n正在对比源端和MinIO...")
+            try:
+                sync_source(
+                    ali_client if is_ali else tx_client, is_ali,
+                    ali_status if is_ali else tx_status, minio_client, delete
+                )
+            except Exception as e:
+                print(f"增量同步失败: {str(e)}")
+        
+        elif choice == '12':
+            force = input("是否忽略退避时间和重试次数限制，重试全部失败文件? (y/N): ").lower() == 'y'
+            print("\n=== 阿里云 ===")
+            retry_failed('aliyun', ali_status, minio_client, force)
+            print("\n=== 腾讯云 ===")
+            retry_failed('tencent', tx_status, minio_client, force)
+        
         elif choice == '0':
+            scan_stop.set()
             print("程序退出")
             break
         
         else:
             print("无效的选择，请重试")
 
+def run_cli(argv):
+    """非交互的命令行入口"""
+    parser = argparse.ArgumentParser(description='迁移阿里云OSS/腾讯云COS文件到MinIO')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = subparsers.add_parser('list', help='列出源端文件（使用本地列表缓存）')
+    list_parser.add_argument('source', choices=['aliyun', 'tencent'])
+    list_parser.add_argument('--filter', default='', help='前缀或通配符，例如 images/ 或 *.jpg')
+    list_parser.add_argument('--refresh', action='store_true', help='忽略缓存重新列举')
+
+    download_parser = subparsers.add_parser('download', help='下载指定的key，或列表中匹配过滤条件的全部文件')
+    download_parser.add_argument('source', choices=['aliyun', 'tencent'])
+    download_parser.add_argument('keys', nargs='*', help='要下载的key，不指定时下载全部匹配文件')
+    download_parser.add_argument('--filter', default='', help='前缀或通配符')
+    download_parser.add_argument('--refresh', action='store_true', help='忽略缓存重新列举')
+    download_parser.add_argument('--workers', type=int, help='下载线程数')
+
+    upload_parser = subparsers.add_parser('upload', help='上传该来源已下载到本地的文件')
+    upload_parser.add_argument('source', choices=['aliyun', 'tencent'])
+    upload_parser.add_argument('--workers', type=int, help='上传线程数')
+
+    status_parser = subparsers.add_parser('status', help='显示迁移状态总结')
+    status_parser.add_argument('source', choices=['aliyun', 'tencent'])
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='流水线迁移：边下载边上传，上传校验后删除本地文件')
+    pipeline_parser.add_argument('source', choices=['aliyun', 'tencent'])
+    pipeline_parser.add_argument('--staging-limit', type=int, help='本地暂存字节数上限')
+    pipeline_parser.add_argument('--download-workers', type=int, help='下载线程数')
+    pipeline_parser.add_argument('--upload-workers', type=int, help='上传线程数')
+
+    retry_parser = subparsers.add_parser('retry', help='只重试失败记录中的对象')
+    retry_parser.add_argument('source', choices=['aliyun', 'tencent'])
+    retry_parser.add_argument('--force', action='store_true', help='忽略退避时间和重试次数限制')
+
+    worker_parser = subparsers.add_parser('worker', help='分片工作节点：与其他节点协调领取分片并直接迁移')
+    worker_parser.add_argument('source', choices=['aliyun', 'tencent'])
+    worker_parser.add_argument('--workers', type=int, help='每个分片的并发传输数')
+    worker_parser.add_argument('--id', help='节点标识，默认为 主机名-进程号')
+
+    verify_parser = subparsers.add_parser('verify', help='列举MinIO批量核对上传记录，输出问题报告')
+    verify_parser.add_argument('source', nargs='?', choices=['aliyun', 'tencent'], help='默认核对两个来源')
+    verify_parser.add_argument('--report', help='问题报告文件路径')
+
+    merge_parser = subparsers.add_parser('merge', help='合并各分片状态并显示迁移总结')
+    merge_parser.add_argument('source', choices=['aliyun', 'tencent'])
+
+    args = parser.parse_args(argv)
+    is_ali = args.source == 'aliyun' if args.source else None
+    if args.command == 'list':
+        if not ensure_listing(create_source_client(args.source), is_ali, args.refresh):
+            return 1
+        cache = get_listing_cache()
+        after = -1
+        while True:
+            rows = cache.page(args.source, args.filter, after, LIST_PAGE_SIZE)
+            for _, file_key, size in rows:
+                print(f"{file_key}\t{size}")
+            if len(rows) < LIST_PAGE_SIZE:
+                return 0
+            after = rows[-1][0]
+    if args.command == 'download':
+        status_tracker = FileStatus(args.source)
+        if args.keys:
+            files, sizes = args.keys, None
+        else:
+            if not ensure_listing(create_source_client(args.source), is_ali, args.refresh):
+                return 1
+            cache = get_listing_cache()
+            files, sizes = cache.keys(args.source, args.filter), cache.sizes(args.source, args.filter)
+        succeeded, failed, _ = download_all(files, is_ali, status_tracker, args.workers, sizes)
+        return 1 if failed else 0
+    if args.command == 'upload':
+        status_tracker = FileStatus(args.source)
+        succeeded, failed, _ = upload_all(
+            list_staged_files(args.source),
+            status_tracker if is_ali else None, None if is_ali else status_tracker,
+            create_minio_client(), args.workers
+        )
+        return 1 if failed else 0
+    if args.command == 'status':
+        show_migration_summary(FileStatus(args.source))
+        return 0
+    if args.command == 'pipeline':
+        succeeded, failed = run_pipeline(
+            args.source, args.staging_limit, args.download_workers, args.upload_workers
+        )
+        return 1 if failed else 0
+    if args.command == 'retry':
+        succeeded, failed = retry_failed(
+            args.source, FileStatus(args.source), create_minio_client(), args.force
+        )
+        return 1 if failed else 0
+    if args.command == 'worker':
+        completed, failed = run_worker(args.source, args.workers, args.id)
+        return 1 if failed else 0
+    if args.command == 'verify':
+        sources = [args.source] if args.source else ['aliyun', 'tencent']
+        verified, problems = verify_all(
+            create_minio_client(), {source: FileStatus(source) for source in sources}, report_path=args.report
+        )
+        return 1 if problems else 0
+    if args.command == 'merge':
+        status_tracker = FileStatus(args.source)
+        merged = merge_shard_status(args.source, status_tracker)
+        print(f"已合并 {merged} 个分片的状态")
+        show_shard_progress(args.source)
+        show_migration_summary(status_tracker)
+        return 0
+    return 0
+
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    start_metrics_reporter()
+    if len(sys.argv) > 1:
+        sys.exit(run_profiled(run_cli, sys.argv[1:]))
+    run_profiled(main)
@@ -0,0 +1,113 @@
+"""分片协调和key范围分片的测试"""
+import bisect
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import migrate_to_minio as m
+
+
+class FakeBucket:
+    """按key排序的假OSS bucket，只实现分片列举用到的list_objects"""
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+
+    def list_objects(self, prefix='', delimiter='', marker='', max_keys=100):
+        start = bisect.bisect_right(self.keys, marker) if marker else 0
+        keys = [key for key in self.keys[start:] if key.startswith(prefix)][:max_keys]
+        truncated = start + len(keys) < len(self.keys) and len(keys) == max_keys
+        return SimpleNamespace(
+            object_list=[SimpleNamespace(key=key, size=1, etag='"x"', last_modified=0) for key in keys],
+            prefix_list=[],
+            is_truncated=truncated,
+            next_marker=keys[-1] if truncated else ''
+        )
+
+
+@pytest.fixture
+def small_pages(monkeypatch):
+    monkeypatch.setattr(m, 'LIST_PAGE_SIZE', 7)
+
+
+@pytest.mark.parametrize('count, shard_count', [(1000, 8), (3, 64), (0, 4)])
+def test_range_shards_partition_keys(small_pages, count, shard_count):
+    keys = [f"dir{index % 5}/file{index:05d}" for index in range(count)]
+    bucket = FakeBucket(keys)
+    shards = m.sample_range_markers(bucket, True, shard_count)
+    assert shards[0] == '' and shards == sorted(set(shards)) and len(shards) <= shard_count
+
+    listed = []
+    for shard in shards:
+        part = list(m.iter_shard_keys(bucket, True, shard, 'range', shard_count, shards))
+        listed.extend(part)
+        if count >= shard_count * 10:
+            # 采样均分后各范围的对象数相近
+            assert count / shard_count / 2 <= len(part) <= count / shard_count * 2
+    assert listed == sorted(keys)
+
+
+@pytest.fixture(params=['sqlite', 'lockdir'])
+def coordinator(request, tmp_path):
+    if request.param == 'sqlite':
+        return m.SqliteLeaseCoordinator(str(tmp_path / 'leases.db'), 0.2)
+    return m.LockDirLeaseCoordinator(str(tmp_path / 'locks'), 0.2)
+
+
+def test_claim_is_exclusive(coordinator):
+    coordinator.ensure_shards('aliyun', ['a', 'b'])
+    coordinator.ensure_shards('aliyun', ['a', 'b'])
+    claimed = {coordinator.claim('aliyun', 'n1'), coordinator.claim('aliyun', 'n2')}
+    assert claimed == {'a', 'b'}
+    assert coordinator.claim('aliyun', 'n3') is None
+    assert coordinator.renew('aliyun', 'a', 'n1') != coordinator.renew('aliyun', 'a', 'n2')
+
+
+def test_expired_lease_is_reclaimed(coordinator):
+    coordinator.ensure_shards('aliyun', ['a'])
+    assert coordinator.claim('aliyun', 'n1') == 'a'
+    time.sleep(0.3)
+    assert coordinator.claim('aliyun', 'n2') == 'a'
+    assert not coordinator.renew('aliyun', 'a', 'n1')
+    assert coordinator.renew('aliyun', 'a', 'n2')
+
+
+def test_complete_requires_current_owner(coordinator):
+    coordinator.ensure_shards('aliyun', ['a'])
+    coordinator.claim('aliyun', 'n1')
+    time.sleep(0.3)
+    coordinator.claim('aliyun', 'n2')
+
+    assert not coordinator.complete('aliyun', 'a', 'n1', 0)
+    # 旧持有者的完成请求不能影响新持有者的租约
+    assert coordinator.claim('aliyun', 'n3') is None
+    assert coordinator.renew('aliyun', 'a', 'n2')
+
+    assert coordinator.complete('aliyun', 'a', 'n2', 3)
+    [shard] = coordinator.progress('aliyun')
+    assert shard['done'] and shard['owner'] == 'n2' and shard['failed'] == 3
+    assert coordinator.claim('aliyun', 'n3') is None
+
+
+def test_keep_lease_reports_lost_lease(coordinator):
+    coordinator.ensure_shards('aliyun', ['a'])
+    coordinator.claim('aliyun', 'n1')
+    time.sleep(0.3)
+    coordinator.claim('aliyun', 'n2')
+    stop, lost = threading.Event(), threading.Event()
+    thread = threading.Thread(target=m.keep_lease, args=(coordinator, 'aliyun', 'a', 'n1', stop, lost))
+    thread.start()
+    thread.join(5)
+    assert lost.is_set()
+    assert list(m.iter_until(iter(range(3)), lost)) == []
+
+
+def test_first_registered_plan_wins(coordinator):
+    assert coordinator.register_plan('aliyun', ['', 'm']) == ['', 'm']
+    # 同时采样的其他节点得到不同的marker，不能混入已登记的划分
+    assert coordinator.register_plan('aliyun', ['', 'k', 't']) == ['', 'm']
+    assert [item['shard'] for item in coordinator.progress('aliyun')] == ['', 'm']
@@ -0,0 +1,48 @@
+"""增量同步中列表比对的测试"""
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import migrate_to_minio as m
+
+MD5_A = 'a' * 32
+MD5_B = 'b' * 32
+
+
+def obj(key, size=1, etag=MD5_A, minutes=0):
+    return m.make_object_info(key, size, etag, datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=minutes))
+
+
+def test_diff_listings():
+    source = [obj('a'), obj('b', size=2), obj('c', etag=MD5_B, minutes=10), obj('e')]
+    minio = [obj('a'), obj('b'), obj('c', minutes=5), obj('d')]
+    records = {'c': {'hash': MD5_A, 'etag': MD5_A}}
+    assert [(kind, item['key']) for kind, item in m.diff_listings(source, minio, records)] == [
+        ('changed', 'b'), ('changed', 'c'), ('deleted', 'd'), ('new', 'e')
+    ]
+    assert list(m.diff_listings([], [])) == []
+
+
+def test_different_part_sizes_are_not_a_change():
+    # 源端按10MiB分片、MinIO按16MiB分片上传的同一内容，ETag不同但没有变化
+    size = 20 * 1024 * 1024
+    assert not m.object_changed(obj('a', size, 'aaaa-2'), obj('a', size, 'bbbb-2', minutes=5))
+    assert m.object_changed(obj('a', size, 'aaaa-2', minutes=10), obj('a', size, 'bbbb-2', minutes=5))
+
+
+def test_non_md5_source_etag_is_not_a_change():
+    # SSE-KMS加密的单分片对象：ETag形如MD5但不是内容MD5
+    assert not m.object_changed(obj('a', etag='c' * 32), obj('a', etag=MD5_A, minutes=5))
+
+
+def test_known_hashes_decide_changes():
+    record = {'hash': MD5_A, 'etag': 'ffff-3'}
+    minio_obj = obj('a', etag='ffff-3', minutes=5)
+    # 去重索引记录过该源端ETag对应的MD5
+    assert not m.object_changed(obj('a', etag='kms1'), minio_obj, record, {'kms1:1': MD5_A})
+    assert m.object_changed(obj('a', etag='kms2'), minio_obj, record, {'kms2:1': MD5_B})
+    # 源端ETag就是上传记录中的MD5
+    assert not m.object_changed(obj('a', etag=MD5_A), minio_obj, record)
+    # 新的源端ETag无法判断内容时按修改时间
+    assert m.object_changed(obj('a', etag=MD5_B, minutes=10), minio_obj, record)